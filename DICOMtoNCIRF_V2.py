@@ -67,18 +67,8 @@ def calculatephantomAge(examDate,birthDate):
         ph_age = 6
     return ph_age
 
-#   Begin Main Processing 
-
-try:
-
-    dicom_file_path = "/Users/macindochi/Library/CloudStorage/Box-Box/BCH/Project/Angio CT Comparison Study/20231030 Document from Dr Maschietto/AS/20191115 XA/AS_XA.dcm"
-    
-    directory = os.path.dirname(dicom_file_path)
-    file_name_with_ext = os.path.basename(dicom_file_path)
-    
-    file_name = os.path.splitext(file_name_with_ext)[0]
-        
-    raw_dcm, paras = ret_all_fl_series(dicom_file_path)
+# Function to extract the parameter dictionary of every irradiation event series
+def extract_all_series(paras):
     
     dict_all_series = []
     se_all_series = []
@@ -117,28 +107,10 @@ try:
         se_all_series.append(dict_se)
         dict_all_series.append(dict1)
     
-    target_save = directory + '\\' + file_name + '_para.xlsx'
-    
-    se_all_series_concat = pd.concat(se_all_series,axis=1)
-    
-    # Use the xlsxwriter engine for ExcelWriter
-    with ExcelWriter(target_save, engine='xlsxwriter') as writer:
-        # Write DataFrame to Excel
-        se_all_series_concat.to_excel(writer, sheet_name='sheetName', na_rep='NaN')
-    
-        # Access the workbook and worksheet
-        workbook = writer.book
-        worksheet = writer.sheets['sheetName']
-    
-        # Adjust column widths dynamically
-        for col_idx, col in enumerate(se_all_series_concat.columns):
-            # Calculate column width based on content
-            column_length = max(
-                se_all_series_concat[col].astype(str).map(len).max(),
-                len(str(col))
-            )
-            # Set the column width
-            worksheet.set_column(col_idx, col_idx, column_length)
+    return dict_all_series, se_all_series
+
+# Function to convert the parameter dictionaries of all irradiation events into NCIRF batch rows
+def build_ncirf_rows(raw_dcm, dict_all_series):
     
     ncirf_all = []
     
@@ -363,14 +335,68 @@ try:
             #   ncirf.append(8) # for manual designation of the number of computing cores.
             
             ncirf_all.append(ncirf)
+    
+    return ncirf_all
+
+# Function to convert an RDSR file into NCIRF batch rows without writing any output
+# run_settings is accepted for a common converter interface; this version uses its fixed settings
+def convert_rdsr(dicom_file_path, run_settings=None):
+    
+    raw_dcm, paras = ret_all_fl_series(dicom_file_path)
+    dict_all_series, se_all_series = extract_all_series(paras)
+    
+    return build_ncirf_rows(raw_dcm, dict_all_series)
+
+
+if __name__ == '__main__':
+
+    #   Begin Main Processing 
+
+    try:
+
+        dicom_file_path = "/Users/macindochi/Library/CloudStorage/Box-Box/BCH/Project/Angio CT Comparison Study/20231030 Document from Dr Maschietto/AS/20191115 XA/AS_XA.dcm"
+    
+        directory = os.path.dirname(dicom_file_path)
+        file_name_with_ext = os.path.basename(dicom_file_path)
+    
+        file_name = os.path.splitext(file_name_with_ext)[0]
+        
+        raw_dcm, paras = ret_all_fl_series(dicom_file_path)
+    
+        dict_all_series, se_all_series = extract_all_series(paras)
+    
+        target_save = directory + '\\' + file_name + '_para.xlsx'
+    
+        se_all_series_concat = pd.concat(se_all_series,axis=1)
+    
+        # Use the xlsxwriter engine for ExcelWriter
+        with ExcelWriter(target_save, engine='xlsxwriter') as writer:
+            # Write DataFrame to Excel
+            se_all_series_concat.to_excel(writer, sheet_name='sheetName', na_rep='NaN')
+    
+            # Access the workbook and worksheet
+            workbook = writer.book
+            worksheet = writer.sheets['sheetName']
+    
+            # Adjust column widths dynamically
+            for col_idx, col in enumerate(se_all_series_concat.columns):
+                # Calculate column width based on content
+                column_length = max(
+                    se_all_series_concat[col].astype(str).map(len).max(),
+                    len(str(col))
+                )
+                # Set the column width
+                worksheet.set_column(col_idx, col_idx, column_length)
+    
+        ncirf_all = build_ncirf_rows(raw_dcm, dict_all_series)
             
-    #   Save the output file
+        #   Save the output file
     
-    target_save = directory + '/' + file_name + '.csv'
+        target_save = directory + '/' + file_name + '.csv'
     
-    with open(target_save, 'w') as f:
-        fc = csv.writer(f, lineterminator='\n')
-        fc.writerows(ncirf_all)
+        with open(target_save, 'w') as f:
+            fc = csv.writer(f, lineterminator='\n')
+            fc.writerows(ncirf_all)
         
-except Exception as e:
-    print(f"Error: {e}")
\ No newline at end of file
+    except Exception as e:
+        print(f"Error: {e}")
\ No newline at end of file
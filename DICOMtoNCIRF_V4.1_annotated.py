@@ -3,6 +3,10 @@
 Created on Tue Jan 24 15:26:20 2023
 Ver 4 is an upgraded version from Ver 1.3 programmed by Andy LaBella, PhD
 Ver 4.1 includes correction of field width/height accounting for SID and SDD
+Irradiation events of a single RDSR can be converted in parallel chunks on a worker pool
+Run settings can be read from a run profile, and a job manifest is written next to every CSV
+Irradiation events are validated before the rows are emitted; flagged events can be dropped
+The CSV and its manifest are written through an output sink (local, atomic, object store or spool directory)
 
 @author: Sang Hoon Chong, PhD
 """
@@ -10,26 +14,50 @@ Ver 4.1 includes correction of field width/height accounting for SID and SDD
 import pydicom
 import json
 import pandas as pd
-from datetime import datetime
 from math import sqrt
-import csv
 from scipy.interpolate import RegularGridInterpolator
 import numpy as np
 import os
 import psutil
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from ncirf_jobs import (load_run_profile, profile_or_input, file_sha256, build_code_version, compute_job_key,
+                        is_job_current, build_job_manifest, write_job_manifest)
+from ncirf_validation import validate_events, summarize_validation, field_size_method
+from ncirf_demographics import DemographicsResolver, demographics_from_json
+from ncirf_sinks import open_sink, rows_to_csv_bytes
+from ncirf_workers import init_worker
+
+CONVERTER_VERSION = '4.1'
+
+# Directory of the HVL databases; defaults to the directory of this script, where hvl_copper_filter.xlsx is shipped
+HVL_DATABASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Modules whose code determines the NCIRF rows, the manifest or the CSV bytes; they are hashed into the job key
+CODE_MODULES = ['ncirf_validation', 'ncirf_demographics', 'ncirf_jobs', 'ncirf_sinks']
+
+# Function to list the files, besides this script, that the code version of a job is made of
+def code_dependency_paths():
+    return [sys.modules[name].__file__ for name in CODE_MODULES] + [hvl_database_path('copper')]
 
 # Function to read DICOM file and extract relevant fluoroscopy series
+# Only the header, without the content tree, is converted to DICOM JSON here. The irradiation event series are
+# returned as pydicom sequences and converted to JSON event by event in extract_event_parameters, on the worker pool.
 def ret_all_fl_series(inp_file):
     a = pydicom.filereader.dcmread(inp_file)
-    b = a.to_json()
-    raw_dcm = json.loads(b)
     
-    d = raw_dcm['0040A730']['Value']
+    header = pydicom.Dataset()
+    for elem in a:
+        if elem.tag != 0x0040A730:
+            header.add(elem)
+    raw_dcm = json.loads(header.to_json())
+    
+    d = a[0x0040A730].value
     
     res = [i for i in d if not (len(i) < 5)]
     
-    paras = [i['0040A730']['Value'] for i in res]
+    paras = [i[0x0040A730].value for i in res]
     
     paras = [i for i in paras if not (len(i) < 20)]
     
@@ -55,25 +83,29 @@ def para_extract(sub_tree):
     else:
         return para_name, para_val[0]
 
-# Function to calculate phantom age group based on birthdate and exam date
-# Returns group 1-6 depending on patient age    
-def calculatephantomAge(examDate,birthDate):
+# Function to load the HVL database and build its interpolator
+# Cached so that the spreadsheet is read once per process instead of once per irradiation event
+@lru_cache(maxsize=None)
+def load_hvl_interpolator(beam_quality_path):
+    
+    hvl_db = pd.read_excel(beam_quality_path, index_col = 0)
+    
+    thickness_array = hvl_db.index.to_numpy()
+    kvp_array = hvl_db.columns.to_numpy().astype(float)
+    hvl_array = hvl_db.values
+    
+    return RegularGridInterpolator((thickness_array, kvp_array), hvl_array)
 
-    today = examDate
-    age = today.year - birthDate.year - ((today.month, today.day) < (birthDate.month, birthDate.day))
-    if age < 1:
-        ph_age = 1
-    elif age >=1 and age < 5:
-        ph_age = 2
-    elif age >=5 and age < 10:
-        ph_age = 3
-    elif age >= 10 and age < 15:
-        ph_age = 4
-    elif age >= 15 and age < 18:
-        ph_age = 5
+# Function to return the path of the HVL database of a filter material
+def hvl_database_path(flt_material):
+    
+    if 'copper' in flt_material.lower():
+        
+        #   Designate the path to the HVL database (HVL_DATABASE_DIR above)
+        return os.path.join(HVL_DATABASE_DIR, 'hvl_copper_filter.xlsx')
+    # Add 'elif' statement to include another kind of filter material.
     else:
-        ph_age = 6
-    return ph_age
+        raise ValueError(f'No HVL database for filter material {flt_material}.')
 
 # Function to estimate beam quality (HVL) based on kVp and filter information
 # Interpolates based on a copper filter HVL database
@@ -92,19 +124,7 @@ def estimatebeamquality(kvp, flt_material, flt_thickness):
     
     kvp_ncirf = round(kvp/10)*10
     
-    if 'copper' in flt_material.lower():
-        
-        #   Designate the path to the HVL database
-        beam_quality_path = "[Path to HVL Database]/hvl_copper_filter.xlsx"
-    # Add 'elif' or 'else' statement to include another kind of filter material.
-    
-    hvl_db = pd.read_excel(beam_quality_path, index_col = 0)
-    
-    thickness_array = hvl_db.index.to_numpy()
-    kvp_array = hvl_db.columns.to_numpy().astype(float)
-    hvl_array = hvl_db.values
-    
-    interpolator = RegularGridInterpolator((thickness_array, kvp_array), hvl_array)
+    interpolator = load_hvl_interpolator(hvl_database_path(flt_material))
     
     point = np.array([[kvp, flt_thickness]])
     hvl = interpolator(point)[0]
@@ -153,296 +173,494 @@ def presetisocenter(target_region, phantom_age_group):
     iso_x, iso_y, iso_z = coord
     return iso_x, iso_y, iso_z
 
+# Function to extract the parameter dictionary of a single irradiation event series
+# The content items of the series are converted to DICOM JSON one at a time
+def extract_event_parameters(event):
+    
+    dict1={}
+    
+    for item in event:
+        j = item.to_json_dict()
+        
+        # Extract depending on length of j
+        if len(j) == 4:
+            
+            para_name, para_val = para_extract(j)
+            dict1[para_name[0]] = para_val
+            
+        elif len(j) == 5:
+            
+            if j['0040A043']['Value'][0]['00080104']['Value'][0] == 'X-Ray Filters':
+                sub_para = j[list(j.keys())[-1]]['Value']
+                para_name = j['0040A043']['Value'][0]['00080104']['Value']
+    
+                for k in sub_para:
+                    
+                    para_name, para_val = para_extract(k)
+                    dict1[para_name[0]] = para_val
+                
+            else:
+                sub_para = j[list(j.keys())[-1]]['Value'][0]
+                para_name, para_val = para_extract(sub_para)
+                dict1[para_name[0]] = para_val
+            
+        elif len(j) == 6:
+            
+            sub_para = j[list(j.keys())[-1]]['Value']
+            para_name = j['0040A043']['Value'][0]['00080104']['Value']
 
-# Begin Main Processing block (protected by try-except)
-try:
+            for k in sub_para:
+                
+                para_name, para_val = para_extract(k)
+                dict1[para_name[0]] = para_val
+                
+        else:
+            raise ValueError('A very specific bad thing happened.')
+    
+    return dict1
 
-    #   Please designate the dicom file path here before running the entire script.
-    dicom_file_path = "/Users/macindochi/Library/CloudStorage/Box-Box/BCH/Project/Angio CT Comparison Study/20231030 Document from Dr Maschietto/AS/20191115 XA/AS_XA.dcm" 
+# Function to convert the parameter dictionary of one irradiation event into an NCIRF batch row
+# run_settings holds the patient/phantom and simulation settings shared by every row of the study
+# Returns the row and a record of how its values were derived; the row is None for events without DAP, which are not simulated
+def build_ncirf_row(i, run_settings):
     
-    directory = os.path.dirname(dicom_file_path)
-    file_name_with_ext = os.path.basename(dicom_file_path)
+    if i['Dose Area Product'] == 0:
+        return None, None
     
-    file_name = os.path.splitext(file_name_with_ext)[0]
-        
-    raw_dcm, paras = ret_all_fl_series(dicom_file_path)
+    ncirf = []
+    derivation = {'irradiation_event_uid': i.get('Irradiation Event UID')}
     
-    dict_all_series = []
-    se_all_series = []
+    #ID
+    ncirf.append(run_settings['patient_id'])
     
-    # Patient demographic info
-    pat_birth_date = datetime.strptime(raw_dcm['00100030']['Value'][0], '%Y%m%d')
-    pat_study_date = datetime.strptime(raw_dcm['00080020']['Value'][0], '%Y%m%d')
-    phantom_group = calculatephantomAge(pat_study_date, pat_birth_date)
+    # arm position
+    ncirf.append(run_settings['arm_position'])
     
-    # Check birthdate info; if missing, request user input
-    if 'Value' in raw_dcm['00100030']:
-        pat_birth_date = datetime.strptime(raw_dcm['00100030']['Value'][0], '%Y%m%d')
-        pat_study_date = datetime.strptime(raw_dcm['00080020']['Value'][0], '%Y%m%d')
-        phantom_group = calculatephantomAge(pat_study_date, pat_birth_date)
+    # phantom age group
+    ncirf.append(run_settings['phantom_group'])
+
+    # phantom sex
+    ncirf.append(run_settings['patient_sex'])
+        
+    # kVp & beam quality
+    filter_material = i['X-Ray Filter Material']
+    
+    filter_min_thickness = i['X-Ray Filter Thickness Minimum']
+    filter_max_thickness = i['X-Ray Filter Thickness Maximum']
+    
+    if filter_min_thickness != filter_max_thickness:
+        raise ValueError('X-ray filter is not flat.')
     else:
-        phantom_group = int(input("No patient birth date specified. Please choose phantom age group.\nEnter 1 for age < 1\nEnter 2 for 1<= age < 5\nEnter 3 for 5<= age < 10/nEnter 4 for 10<= age < 15/nEnter 5 for 15<= age < 18/nEnter 6 for age >= 18 :"))
-    
-    # if raw_dcm['00100040']['Value'][0] == 'F':
-    #     patient_sex = 'female'
-    # elif raw_dcm['00100040']['Value'][0] == 'M':
-    #     patient_sex = 'male'
-    # else:
-    #     print('Patient sex is not assigned properly. The execution stops.')
-    #     sys.exit()
-    
-    # Patient sex
-    if 'Value' in raw_dcm['00100040']: 
-        if raw_dcm['00100040']['Value'][0] == 'F':
-            patient_sex = 1
-        elif raw_dcm['00100040']['Value'][0] == 'M':
-            patient_sex = 2
+        filter_thickness = filter_min_thickness
+    
+    kvp_ncirf, hvl_ncirf = estimatebeamquality(i['KVP'], filter_material, filter_thickness)
+    
+    # kVp
+    ncirf.append(kvp_ncirf)
+    derivation['kvp'] = f"KVP {i['KVP']} rounded to {kvp_ncirf}"
+    
+    # HVL
+    ncirf.append(hvl_ncirf)
+    derivation['hvl'] = f'NCIRF beam quality nearest to the HVL interpolated for {filter_thickness} mm {filter_material}'
+    
+    # SID
+    sid = i['Distance Source to Isocenter']
+    ncirf.append(sid/10)
+    
+    # field width at isocenter (cm)
+    # field height at isocenter (cm)
+    
+    if 'Distance Source to Reference Point' in i:
+        srd = i['Distance Source to Reference Point']                
+        derivation['srd'] = 'Distance Source to Reference Point'
     else:
-        patient_sex = 1 # Default to female
-        print('No sex specified in RDSR - default to F')
-    
-    arm_position = int(input("Please choose phantom posture depending on arm position. 1 = Arm-raised, 2 = Arm-lowered, 3 = Arm-rotated.: "))
-    
-    # Interpret arm position into text
-    if arm_position == 1:
-        position_statement = 'raised'
-    elif arm_position == 2:
-        position_statement = 'lowered'
-    elif arm_position == 3:
-        position_statement = 'rotated'
+        srd = sid - 150
+        derivation['srd'] = 'Distance Source to Isocenter - 150'
+    
+    sdd = i['Distance Source to Detector']
+    cf_srd = sid/srd #  Correction factor for reference point to isocenter point.
+    cf_sdd = sid/sdd #  Correction factor for image recepter point to isocenter point.
+    
+    # The derivation is chosen by field_size_method, which the validation stage shares
+    field_size = field_size_method(i)
+    
+    if field_size == 'dap_dose_rp':
+        ncirf.append(sqrt(i['Dose Area Product']/i['Dose (RP)'])*100*cf_srd)
+        ncirf.append(sqrt(i['Dose Area Product']/i['Dose (RP)'])*100*cf_srd)
+        derivation['field_size'] = 'sqrt(Dose Area Product / Dose (RP)) at reference point'
+    elif field_size == 'width_height':
+        ncirf.append(i['Collimated Field Width']/10*cf_sdd) #  /10 because Collimated Field Width in mm
+        ncirf.append(i['Collimated Field Height']/10*cf_sdd)
+        derivation['field_size'] = 'Collimated Field Width and Height at detector'
+    elif field_size == 'area':
+        ncirf.append(sqrt(i['Collimated Field Area'])*100*cf_sdd) # *100 because Collimated Field Area in m^2.
+        ncirf.append(sqrt(i['Collimated Field Area'])*100*cf_sdd)
+        derivation['field_size'] = 'sqrt(Collimated Field Area) at detector'
     else:
-        print('The arm position is not determined clearly. The execution is stopped now.')
-        sys.exit()
+        raise ValueError('No field size can be derived for this irradiation event.')
     
-    # Confirm to user phantom and position
-    if patient_sex == 1:
-        print(f'The patient is female, and the phantom group is {phantom_group} with arms {position_statement}.')
-    else:
-        print(f'The patient is male, and the phantom group is {phantom_group} with arms {position_statement}.')
+    # DAP (Gy*cm2)
+    # add attenuation factor 
+    ncirf.append(i['Dose Area Product'] * 10000)
     
-    # Ask for isocenter coordinates manually
-    print('Open NCIRF to decide the isocenter coordinate and enter them in the following order: x, y, and z.')
+    # Positioner Primary Angle (PPA)
+    ncirf.append(i['Positioner Primary Angle'])
     
-    iso_x = input('Enter the coordinate for x in cm: ')
-    iso_y = input('Enter the coordinate for y in cm: ')
-    iso_z = input('Enter the coordinate for z in cm: ')
+    # Positioner Secondary Angle (PSA)
+    ncirf.append(i['Positioner Secondary Angle'])
     
-    # Convert to float if not empty
-    if iso_x.strip():
-        iso_x = float(iso_x)
-        
-    if iso_y.strip():
-        iso_y = float(iso_y)
-        
-    if iso_z.strip():
-        iso_z = float(iso_z)
+    # Isocenter Coordinate
+    iso_x = run_settings['iso_x']
+    iso_y = run_settings['iso_y']
+    iso_z = run_settings['iso_z']
     
-    # Other user inputs
-    patient_id = int(input('Enter a patient ID. (This is not equivalent to the MRN number): '))
+    #######################################################################################
+    # # If this if-atatement is activated, the preset value deduced from the target region 
+    # # with arm position raised when any of the user input coordiates is found empty,   
+    # if iso_x == '' or iso_y == '' or iso_z == '':           
+    #     iso_x, iso_y, iso_z = presetisocenter(i['Target Region'], ncirf[2])
+    #     ncirf[1] = 1
+    #######################################################################################
     
-    history_num = input('Enter the number of photon history for each irradiation event. If nothing is entered the default nunber is 10M: ')
+    ncirf.extend((iso_x, iso_y, iso_z))
     
-    if history_num.strip():
-        history_num = int(history_num)
-    else:
-        history_num = 10000000
+    # MC History
+    ncirf.append(run_settings['history_num'])
     
-    cpu_core_num = input('Enter the number of CPU cores for simulation process. The maximum number of available cores will be used if nothing is entered: ')
+    # Number of threads
+    ncirf.append(run_settings['cpu_core_num'])
     
-    if cpu_core_num.strip():
-        cpu_core_num = int(cpu_core_num)
-    else:
-        cpu_core_num = psutil.cpu_count(logical=False)
+    return ncirf, derivation
+
+# Function to extract the parameter dictionaries of one chunk of irradiation event series
+def extract_event_chunk(chunk):
+    return [extract_event_parameters(event) for event in chunk]
+
+# Function to extract, validate and convert one chunk of irradiation event series (unit of work of the worker pool)
+# Events the builder cannot convert are never converted; with drop_invalid every flagged event is left out.
+# Returns the validation flags of the chunk, with the irradiation event UID of each event and whether it was dropped
+# or emitted, and the (index in chunk, row, derivation) of every converted event;
+# the parameter dictionaries stay in the worker, so only the flags and the rows are sent back.
+def convert_event_chunk(chunk, run_settings, drop_invalid=False):
     
-    # Process each irradiation event series
-    for i in paras:
-        
-        # i = paras[4]
-        
-        dict1={}
-        
-        for j in i:
-            # Extract depending on length of j
-            if len(j) == 4:
-                
-                para_name, para_val = para_extract(j)
-                dict1[para_name[0]] = para_val
-                
-            elif len(j) == 5:
-                
-                if j['0040A043']['Value'][0]['00080104']['Value'][0] == 'X-Ray Filters':
-                    sub_para = j[list(j.keys())[-1]]['Value']
-                    para_name = j['0040A043']['Value'][0]['00080104']['Value']
+    dict_series = extract_event_chunk(chunk)
+    
+    validation = validate_events(dict_series)
+    validation['irradiation_event_uid'] = [i.get('Irradiation Event UID') for i in dict_series]
+    validation['dropped'] = validation['invalid'] if drop_invalid else validation['unconvertible']
+    
+    converted = []
+    emitted = np.zeros(len(validation), dtype=bool)
+    
+    for k in np.flatnonzero(~validation['dropped'].to_numpy()):
+        ncirf, derivation = build_ncirf_row(dict_series[k], run_settings)
+        converted.append((int(k), ncirf, derivation))
+        emitted[k] = ncirf is not None
+    
+    validation['emitted'] = emitted
+    
+    return validation, converted
+
+# Irradiation event series of the study, set in every worker process by the pool initializer.
+# Each worker receives them once instead of a pickled copy of every chunk; under fork it inherits them.
+worker_event_series = []
+
+def set_worker_event_series(paras):
+    global worker_event_series
+    worker_event_series = paras
+
+# Function to extract, validate and convert the event series start:stop of the study (unit of work of the worker pool)
+def convert_event_range(start, stop, run_settings, drop_invalid=False):
+    return convert_event_chunk(worker_event_series[start:stop], run_settings, drop_invalid)
+
+# Function to extract, validate and convert all irradiation event series of a study
+# The series are split into chunks of chunk_size and handled on a pool of n_workers processes, which receive
+# the series once and are sent only the chunk bounds; the rows are reassembled in the original event order.
+# Workers started by spawn or forkserver load this script from its file (ncirf_workers.init_worker), so the pool
+# also works when the script was loaded under a module name that cannot be imported, e.g. by the regression harness.
+# n_workers = 1 processes the events sequentially.
+# Each event is validated before its row is built. Events the builder cannot convert (a blocking flag)
+# are never converted; with drop_invalid every flagged event is left out.
+# Returns the validation flags of all events (see convert_event_chunk), the NCIRF rows and the derivation record of each row
+def process_events(paras, run_settings, n_workers=1, chunk_size=200, drop_invalid=False):
+    
+    starts = range(0, len(paras), chunk_size)
+    
+    if n_workers > 1 and len(starts) > 1:
+        # Read the copper HVL database before the workers are started so that forked workers inherit it
+        load_hvl_interpolator(hvl_database_path('copper'))
         
-                    for k in sub_para:
-                        
-                        para_name, para_val = para_extract(k)
-                        dict1[para_name[0]] = para_val
-                    
-                else:
-                    sub_para = j[list(j.keys())[-1]]['Value'][0]
-                    para_name, para_val = para_extract(sub_para)
-                    dict1[para_name[0]] = para_val
-                
-            elif len(j) == 6:
-                
-                sub_para = j[list(j.keys())[-1]]['Value']
-                para_name = j['0040A043']['Value'][0]['00080104']['Value']
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(starts)), initializer=init_worker,
+                                 initargs=(__name__, os.path.abspath(__file__), 'set_worker_event_series', (paras,))) as executor:
+            chunk_results = list(executor.map(partial(convert_event_range, run_settings=run_settings, drop_invalid=drop_invalid),
+                                              starts, [start + chunk_size for start in starts]))
+    else:
+        chunk_results = [convert_event_chunk(paras[start:start + chunk_size], run_settings, drop_invalid) for start in starts]
     
-                for k in sub_para:
-                    
-                    para_name, para_val = para_extract(k)
-                    dict1[para_name[0]] = para_val
-                    
-            else:
-                raise ValueError('A very specific bad thing happened.')
+    validations = []
+    ncirf_all = []
+    derivation_all = []
+    
+    for offset, (validation, converted) in zip(starts, chunk_results):
+        validations.append(validation.set_axis(validation.index + offset))
         
-        dict_se = pd.Series(dict1)
-        se_all_series.append(dict_se)
-        dict_all_series.append(dict1)
+        for k, ncirf, derivation in converted:
+            if ncirf is not None:
+                derivation['event_index'] = offset + k
+                derivation['validation_flags'] = validation['validation_flags'].iat[k]
+                ncirf_all.append(ncirf)
+                derivation_all.append(derivation)
+    
+    validation = pd.concat(validations) if validations else convert_event_chunk([], run_settings, drop_invalid)[0]
     
-    # (Optional) save extracted parameters to Excel for debugging
+    return validation, ncirf_all, derivation_all
 
+# Function to convert an RDSR file into NCIRF batch rows without prompting or writing any output
+# run_settings holds the settings otherwise entered interactively; phantom_group and patient_sex are
+# resolved from the demographics, and taken from run_settings only when the demographics do not provide them
+def convert_rdsr(dicom_file_path, run_settings, n_workers=1, chunk_size=200, demographics_resolver=None):
     
-    ################################################################################################
-    # # Activate this part of code to generate an Excel output with the available dictionary data.
+    raw_dcm, paras = ret_all_fl_series(dicom_file_path)
+    
+    if demographics_resolver is None:
+        demographics_resolver = DemographicsResolver()
     
-    # target_save = directory + '\\' + file_name + '_para.xlsx'
+    demographics = demographics_from_json(raw_dcm)
+    demographics_resolver.add_study(demographics)
+    phantom_group, patient_sex, demographic_sources = demographics_resolver.resolve(demographics)
     
-    # se_all_series_concat = pd.concat(se_all_series,axis=1)
+    run_settings = dict(run_settings)
     
-    # # Extracted parameters (more than needed for NCIRF) are saved for troubleshooting.
-    # # Use the xlsxwriter engine for ExcelWriter
-    # with ExcelWriter(target_save, engine='xlsxwriter') as writer:
-    #     # Write DataFrame to Excel
-    #     se_all_series_concat.to_excel(writer, sheet_name='sheetName', na_rep='NaN')
+    if phantom_group is not None:
+        run_settings['phantom_group'] = phantom_group
+    else:
+        run_settings.setdefault('phantom_group', None)
     
-    #     # Access the workbook and worksheet
-    #     workbook = writer.book
-    #     worksheet = writer.sheets['sheetName']
+    if demographic_sources['patient_sex'] != 'default' or 'patient_sex' not in run_settings:
+        run_settings['patient_sex'] = patient_sex
     
-    #     for col_idx, col in enumerate(se_all_series_concat.columns):
-    #         # Calculate column width based on content
-    #         # column_length = max(
-    #         #     se_all_series_concat[col].astype(str).map(len).max(),
-    #         #     len(str(col))
-    #         # )
-    #         # Set the column width
-    #         column_length = 30
-    #         worksheet.set_column(col_idx, col_idx, column_length)
-    #################################################################################################
+    if run_settings['phantom_group'] is None:
+        raise ValueError(f'No patient birth date or age available for {dicom_file_path}. Set phantom_group in the run settings.')
     
-    # Now prepare NCIRF batch input rows
-    ncirf_all = []    
+    validation, ncirf_all, derivation_all = process_events(paras, run_settings, n_workers, chunk_size,
+                                                           run_settings.get('drop_invalid_events', False))
     
-    for i in dict_all_series:
+    return ncirf_all
+
+
+if __name__ == '__main__':
+
+    # Begin Main Processing block (protected by try-except)
+    try:
+
+        #   Please designate the dicom file path here before running the entire script.
+        dicom_file_path = "/Users/macindochi/Library/CloudStorage/Box-Box/BCH/Project/Angio CT Comparison Study/20231030 Document from Dr Maschietto/AS/20191115 XA/AS_XA.dcm" 
+    
+        #   Intra-study parallel mode: the irradiation events are converted in chunks on a pool of event_workers processes.
+        #   Studies of a single chunk are handled without a pool. Set event_workers to 1 to handle the events one after another.
+        #   regression_harness.benchmark_event_workers measures the gain per number of workers on your machine.
+        event_workers = os.cpu_count()
+        event_chunk_size = 200
+    
+        #   Irradiation events flagged by the validation stage (out-of-range kVp, implausible geometry,
+        #   field size inconsistent with DAP/Dose (RP)) are reported in the manifest. Set True to drop them from the CSV.
+        #   Events that cannot be converted at all (missing parameters, no HVL, no field size) are always dropped.
+        #   The manifest lists every event with its flags and whether it was emitted, and is marked incomplete
+        #   when any event was dropped.
+        drop_invalid_events = False
+    
+        #   Optionally designate a run profile (TOML or YAML) holding the settings that are otherwise entered interactively.
+        #   Settings the profile leaves out are still asked for. Leave empty to enter every setting interactively.
+        run_profile_path = ''
+    
+        #   Optionally designate other RDSRs of the same patients. Their birth date, sex and age fill in
+        #   demographics missing from this RDSR instead of asking for them.
+        related_dicom_paths = []
+        demographics_resolver = DemographicsResolver()
+    
+        #   Optionally designate where the CSV and its manifest are written. Leave empty to write them next to the DICOM file.
+        #   's3://bucket/prefix' writes to an S3-compatible object store (set output_endpoint_url for MinIO and the like),
+        #   'spool:///path/to/spool' hands them to the spool directory of the NCIRF scheduler,
+        #   'atomic:///path/to/dir' writes them to a temporary file first and renames it, and a plain path writes them there.
+        output_target = ''
+        output_endpoint_url = None
+    
+        directory = os.path.dirname(dicom_file_path)
+        file_name_with_ext = os.path.basename(dicom_file_path)
+    
+        file_name = os.path.splitext(file_name_with_ext)[0]
         
-        # i = dict_all_series[0]
+        raw_dcm, paras = ret_all_fl_series(dicom_file_path)
+        input_sha256 = file_sha256(dicom_file_path)
+    
+        if run_profile_path:
+            run_profile = load_run_profile(run_profile_path)
+        else:
+            run_profile = {'name': 'interactive'}
+        setting_sources = {}
+    
+        # Patient demographic info
+        # A missing birth date or sex is taken from the other studies of the same patient, then from PatientAge
+        demographics = demographics_from_json(raw_dcm)
+        demographics_resolver.add_files(related_dicom_paths)
+        demographics_resolver.add_study(demographics)
+        phantom_group, patient_sex, demographic_sources = demographics_resolver.resolve(demographics)
+        setting_sources.update(demographic_sources)
+    
+        # If no age is available at all, take the phantom age group from the run profile or request user input
+        if phantom_group is None:
+            phantom_group = int(profile_or_input(run_profile, setting_sources, 'phantom_group', "No patient birth date specified. Please choose phantom age group.\nEnter 1 for age < 1\nEnter 2 for 1<= age < 5\nEnter 3 for 5<= age < 10/nEnter 4 for 10<= age < 15/nEnter 5 for 15<= age < 18/nEnter 6 for age >= 18 :"))
+    
+        # if raw_dcm['00100040']['Value'][0] == 'F':
+        #     patient_sex = 'female'
+        # elif raw_dcm['00100040']['Value'][0] == 'M':
+        #     patient_sex = 'male'
+        # else:
+        #     print('Patient sex is not assigned properly. The execution stops.')
+        #     sys.exit()
+    
+        # Patient sex
+        if setting_sources['patient_sex'] == 'default':
+            print('No sex specified in RDSR - default to F')
+    
+        arm_position = int(profile_or_input(run_profile, setting_sources, 'arm_position', "Please choose phantom posture depending on arm position. 1 = Arm-raised, 2 = Arm-lowered, 3 = Arm-rotated.: "))
+    
+        # Interpret arm position into text
+        if arm_position == 1:
+            position_statement = 'raised'
+        elif arm_position == 2:
+            position_statement = 'lowered'
+        elif arm_position == 3:
+            position_statement = 'rotated'
+        else:
+            print('The arm position is not determined clearly. The execution is stopped now.')
+            sys.exit()
+    
+        # Confirm to user phantom and position
+        if patient_sex == 1:
+            print(f'The patient is female, and the phantom group is {phantom_group} with arms {position_statement}.')
+        else:
+            print(f'The patient is male, and the phantom group is {phantom_group} with arms {position_statement}.')
+    
+        # Ask for isocenter coordinates manually
+        print('Open NCIRF to decide the isocenter coordinate and enter them in the following order: x, y, and z.')
+    
+        iso_x = profile_or_input(run_profile, setting_sources, 'iso_x', 'Enter the coordinate for x in cm: ')
+        iso_y = profile_or_input(run_profile, setting_sources, 'iso_y', 'Enter the coordinate for y in cm: ')
+        iso_z = profile_or_input(run_profile, setting_sources, 'iso_z', 'Enter the coordinate for z in cm: ')
+    
+        # Convert to float if not empty
+        if iso_x.strip():
+            iso_x = float(iso_x)
         
-        if i['Dose Area Product'] == 0:
-            continue
+        if iso_y.strip():
+            iso_y = float(iso_y)
+        
+        if iso_z.strip():
+            iso_z = float(iso_z)
+    
+        # Other user inputs
+        patient_id = int(profile_or_input(run_profile, setting_sources, 'patient_id', 'Enter a patient ID. (This is not equivalent to the MRN number): '))
+    
+        history_num = profile_or_input(run_profile, setting_sources, 'history_num', 'Enter the number of photon history for each irradiation event. If nothing is entered the default nunber is 10M: ')
+    
+        if history_num.strip():
+            history_num = int(history_num)
         else:
-            ncirf = []
-            
-            #ID
-            ncirf.append(patient_id)
-            
-            # arm position
-            ncirf.append(arm_position)
-            
-            # phantom age group
-            ncirf.append(phantom_group)
-
-            # phantom sex
-            ncirf.append(patient_sex)
-                
-            # kVp & beam quality
-            filter_material = i['X-Ray Filter Material']
-            
-            filter_min_thickness = i['X-Ray Filter Thickness Minimum']
-            filter_max_thickness = i['X-Ray Filter Thickness Maximum']
-            
-            if filter_min_thickness != filter_max_thickness:
-                raise ValueError('X-ray filter is not flat.')
-            else:
-                filter_thickness = filter_min_thickness
-            
-            kvp_ncirf, hvl_ncirf = estimatebeamquality(i['KVP'], filter_material, filter_thickness)
-            
-            # kVp
-            ncirf.append(kvp_ncirf)
-            
-            # HVL
-            ncirf.append(hvl_ncirf)
-            
-            # SID
-            sid = i['Distance Source to Isocenter']
-            ncirf.append(sid/10)
-            
-            # field width at isocenter (cm)
-            # field height at isocenter (cm)
-            
-            if 'Distance Source to Reference Point' in i:
-                srd = i['Distance Source to Reference Point']                
+            history_num = 10000000
+            setting_sources['history_num'] = 'default'
+    
+        cpu_core_num = profile_or_input(run_profile, setting_sources, 'cpu_core_num', 'Enter the number of CPU cores for simulation process. The maximum number of available cores will be used if nothing is entered: ')
+    
+        if cpu_core_num.strip():
+            cpu_core_num = int(cpu_core_num)
+        else:
+            # Physical cores of the converting machine, which may differ from the machine running NCIRF
+            cpu_core_num = psutil.cpu_count(logical=False)
+            setting_sources['cpu_core_num'] = 'physical cores of the converting machine'
+    
+        run_settings = {
+            'patient_id': patient_id,
+            'arm_position': arm_position,
+            'phantom_group': phantom_group,
+            'patient_sex': patient_sex,
+            'iso_x': iso_x,
+            'iso_y': iso_y,
+            'iso_z': iso_z,
+            'history_num': history_num,
+            'cpu_core_num': cpu_core_num,
+            'drop_invalid_events': drop_invalid_events,
+            }
+    
+        target_save = file_name + '.csv'
+    
+        code_version = build_code_version(__file__, CONVERTER_VERSION, code_dependency_paths())
+        job_key = compute_job_key(input_sha256, run_settings, code_version)
+    
+        # The CSV and its manifest form one batch; a spool directory names both after the job key
+        output_sink = open_sink(output_target or directory, batch_size=2, endpoint_url=output_endpoint_url, job_id=job_key)
+    
+        # Skip the job if the same input was already converted with the same settings and code
+        if is_job_current(output_sink, target_save, job_key):
+            print(f'{target_save} is up to date (job key {job_key}). Skipping the conversion.')
+            sys.exit()
+    
+        # Process each irradiation event series and prepare the NCIRF batch input rows
+        validation, ncirf_all, derivation_all = process_events(paras, run_settings, event_workers,
+                                                               event_chunk_size, drop_invalid_events)
+    
+        validation_counts = summarize_validation(validation)
+        if validation_counts['invalid']:
+            if drop_invalid_events:
+                action = 'were dropped'
             else:
-                srd = sid - 150
-            
-            sdd = i['Distance Source to Detector']
-            cf_srd = sid/srd #  Correction factor for reference point to isocenter point.
-            cf_sdd = sid/sdd #  Correction factor for image recepter point to isocenter point.
-            
-            if 'Collimated Field Height' in i and 'Collimated Field Width' in i:
-                if i['Collimated Field Area'] == 0 or i['Collimated Field Height'] == 0 or i['Collimated Field Width'] == 0:
-                    ncirf.append(sqrt(i['Dose Area Product']/i['Dose (RP)'])*100*cf_srd)
-                    ncirf.append(sqrt(i['Dose Area Product']/i['Dose (RP)'])*100*cf_srd)
-                else:
-                    ncirf.append(i['Collimated Field Width']/10*cf_sdd) #  /10 because Collimated Field Width in mm
-                    ncirf.append(i['Collimated Field Height']/10*cf_sdd)
-            elif 'Collimated Field Height' not in i or 'Collimated Field Width' not in i:
-                if i['Collimated Field Area'] == 0:
-                    ncirf.append(sqrt(i['Dose Area Product']/i['Dose (RP)'])*100*cf_srd)
-                    ncirf.append(sqrt(i['Dose Area Product']/i['Dose (RP)'])*100*cf_srd)
-                else:
-                    ncirf.append(sqrt(i['Collimated Field Area'])*100*cf_sdd) # *100 because Collimated Field Area in m^2.
-                    ncirf.append(sqrt(i['Collimated Field Area'])*100*cf_sdd)
-            
-            # DAP (Gy*cm2)
-            # add attenuation factor 
-            ncirf.append(i['Dose Area Product'] * 10000)
-            
-            # Positioner Primary Angle (PPA)
-            ncirf.append(i['Positioner Primary Angle'])
-            
-            # Positioner Secondary Angle (PSA)
-            ncirf.append(i['Positioner Secondary Angle'])
-            
-            # Isocenter Coordinate
-            
-            #######################################################################################
-            # # If this if-atatement is activated, the preset value deduced from the target region 
-            # # with arm position raised when any of the user input coordiates is found empty,   
-            # if iso_x == '' or iso_y == '' or iso_z == '':           
-            #     iso_x, iso_y, iso_z = presetisocenter(i['Target Region'], ncirf[2])
-            #     ncirf[1] = 1
-            #######################################################################################
-            
-            ncirf.extend((iso_x, iso_y, iso_z))
-            
-            # MC History
-            ncirf.append(history_num)
-            
-            # Number of threads
-            ncirf.append(cpu_core_num)
+                action = f"were kept except {validation_counts['unconvertible']} that cannot be converted"
+            print(f"{validation_counts['invalid']} irradiation events failed validation and {action}: {validation_counts}")
+            print('The flags of every event are recorded in the job manifest.')
+    
+        # (Optional) save extracted parameters to Excel for debugging
 
-            # Add the parameters in a row                    
-            ncirf_all.append(ncirf)
-            
-    #   Save the output file
-    target_save = directory + '/' + file_name + '.csv'
     
-    with open(target_save, 'w') as f:
-        fc = csv.writer(f, lineterminator='\n')
-        fc.writerows(ncirf_all)
+        ################################################################################################
+        # # Activate this part of code to generate an Excel output with the available dictionary data.
+    
+        # target_save = directory + '\\' + file_name + '_para.xlsx'
+    
+        # dict_all_series = extract_event_chunk(paras)
+        # se_all_series = [pd.Series(i) for i in dict_all_series]
+        # se_all_series_concat = pd.concat(se_all_series,axis=1)
+    
+        # # Extracted parameters (more than needed for NCIRF) are saved for troubleshooting.
+        # # Use the xlsxwriter engine for ExcelWriter
+        # with ExcelWriter(target_save, engine='xlsxwriter') as writer:
+        #     # Write DataFrame to Excel
+        #     se_all_series_concat.to_excel(writer, sheet_name='sheetName', na_rep='NaN')
+    
+        #     # Access the workbook and worksheet
+        #     workbook = writer.book
+        #     worksheet = writer.sheets['sheetName']
+    
+        #     for col_idx, col in enumerate(se_all_series_concat.columns):
+        #         # Calculate column width based on content
+        #         # column_length = max(
+        #         #     se_all_series_concat[col].astype(str).map(len).max(),
+        #         #     len(str(col))
+        #         # )
+        #         # Set the column width
+        #         column_length = 30
+        #         worksheet.set_column(col_idx, col_idx, column_length)
+        #################################################################################################
+    
+        #   Save the output file and its job manifest. Both are written together when the sink is closed.
+        study_instance_uid = raw_dcm['0020000D']['Value'][0]
+        event_validations = validation.rename_axis('event_index').reset_index()[
+            ['event_index', 'irradiation_event_uid', 'validation_flags', 'dropped', 'emitted']].to_dict('records')
+        manifest = build_job_manifest(job_key, dicom_file_path, input_sha256, study_instance_uid, demographics['PatientID'], run_profile,
+                                      run_settings, setting_sources, code_version, derivation_all, event_validations)
+    
+        with output_sink:
+            output_sink.write(target_save, rows_to_csv_bytes(ncirf_all))
+            write_job_manifest(output_sink, target_save, manifest)
         
-except Exception as e:
-    print(f"Error: {e}")
+    except Exception as e:
+        print(f"Error: {e}")
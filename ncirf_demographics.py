@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Resolution of the NCIRF phantom age group and sex from patient demographics
+
+The phantom age group comes from the patient birth date, or, when the birth date is missing, from
+other studies of the same patient or from Patient's Age (0010,1010). Demographics seen in any study
+are kept in an LRU patient table keyed by PatientID, so a batch of RDSRs of the same patient is
+parsed once and never has to stop for a prompt.
+
+The resolver holds plain data only and can be pickled, so it can be handed to worker processes. Each worker
+then resolves from its own snapshot of the patient table: studies it adds are not seen by the parent or the
+other workers, and read_demographics is cached separately in every process. Add the studies of the batch
+to the resolver (add_files) before it is handed to the workers.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+
+import pydicom
+
+# Demographic attributes read from the DICOM header
+DEMOGRAPHIC_TAGS = ['PatientID', 'PatientBirthDate', 'PatientSex', 'PatientAge', 'StudyDate']
+
+# NCIRF phantom sex codes
+PATIENT_SEX_CODES = {'F': 1, 'M': 2}
+
+# Function to parse a DICOM date (YYYYMMDD). Returns None if the date is empty or malformed.
+@lru_cache(maxsize=4096)
+def parse_dicom_date(value):
+
+    if not value:
+        return None
+
+    try:
+        return datetime.strptime(value.strip()[:8], '%Y%m%d')
+    except ValueError:
+        return None
+
+# Function to parse Patient's Age (e.g. '045Y', '006M', '003W', '010D') into years. Returns None if empty or malformed.
+@lru_cache(maxsize=4096)
+def parse_patient_age(value):
+
+    units = {'D': 365.25, 'W': 365.25 / 7, 'M': 12, 'Y': 1}
+
+    if not value or value.strip()[-1:].upper() not in units:
+        return None
+
+    try:
+        return int(value.strip()[:-1]) / units[value.strip()[-1].upper()]
+    except ValueError:
+        return None
+
+# Function to calculate the age in completed years at the exam date
+def age_in_years(exam_date, birth_date):
+    return exam_date.year - birth_date.year - ((exam_date.month, exam_date.day) < (birth_date.month, birth_date.day))
+
+# Function to calculate phantom age group based on age in years
+# Returns group 1-6 depending on patient age
+def phantom_group_from_age(age):
+
+    if age < 1:
+        ph_age = 1
+    elif age >= 1 and age < 5:
+        ph_age = 2
+    elif age >= 5 and age < 10:
+        ph_age = 3
+    elif age >= 10 and age < 15:
+        ph_age = 4
+    elif age >= 15 and age < 18:
+        ph_age = 5
+    else:
+        ph_age = 6
+    return ph_age
+
+# Function to collect the demographic attributes of a study from the DICOM JSON returned by ret_all_fl_series
+def demographics_from_json(raw_dcm):
+
+    json_tags = {
+        'PatientID': '00100020',
+        'PatientBirthDate': '00100030',
+        'PatientSex': '00100040',
+        'PatientAge': '00101010',
+        'StudyDate': '00080020',
+        }
+
+    demographics = {}
+
+    for name, tag in json_tags.items():
+        values = raw_dcm.get(tag, {}).get('Value')
+        demographics[name] = str(values[0]) if values else None
+
+    return demographics
+
+# Function to read the demographic attributes of a study from the DICOM header only
+# Cached per process so that a file is read once however often it is looked up
+@lru_cache(maxsize=4096)
+def read_demographics(dicom_path):
+
+    ds = pydicom.dcmread(dicom_path, stop_before_pixels=True, specific_tags=DEMOGRAPHIC_TAGS)
+
+    return {name: (str(ds.get(name)) if ds.get(name) else None) for name in DEMOGRAPHIC_TAGS}
+
+
+# Class to resolve phantom age group and sex, pooling the demographics of all studies seen per patient
+# The patient table belongs to the process holding the resolver; a pickled copy is an independent snapshot
+class DemographicsResolver:
+
+    def __init__(self, table_size=1024):
+        self.table_size = table_size
+        self.patient_table = OrderedDict()
+
+    # Function to add the demographics of one study to the patient table
+    def add_study(self, demographics):
+
+        patient_id = demographics.get('PatientID')
+
+        if not patient_id:
+            return
+
+        entry = self.patient_table.pop(patient_id, None) or {'birth_date': None, 'sex': None, 'ages': []}
+
+        birth_date = parse_dicom_date(demographics.get('PatientBirthDate'))
+        if birth_date is not None:
+            entry['birth_date'] = birth_date
+
+        if demographics.get('PatientSex') in PATIENT_SEX_CODES:
+            entry['sex'] = demographics['PatientSex']
+
+        age = parse_patient_age(demographics.get('PatientAge'))
+        study_date = parse_dicom_date(demographics.get('StudyDate'))
+        if age is not None and study_date is not None:
+            entry['ages'].append((study_date, age))
+
+        # Most recently used patients are kept at the end; the least recently used one is evicted
+        self.patient_table[patient_id] = entry
+        if len(self.patient_table) > self.table_size:
+            self.patient_table.popitem(last=False)
+
+    # Function to add the demographics of the studies in a list of DICOM files to the patient table
+    def add_files(self, dicom_paths):
+        for dicom_path in dicom_paths:
+            self.add_study(read_demographics(dicom_path))
+
+    # Function to resolve the phantom age group and sex of a study
+    # Returns phantom_group (None if no source is available), patient_sex, and the source of each value
+    def resolve(self, demographics):
+
+        entry = self.patient_table.get(demographics.get('PatientID'))
+        if entry is not None:
+            self.patient_table.move_to_end(demographics['PatientID'])
+        else:
+            entry = {'birth_date': None, 'sex': None, 'ages': []}
+
+        study_date = parse_dicom_date(demographics.get('StudyDate'))
+        birth_date = parse_dicom_date(demographics.get('PatientBirthDate'))
+        patient_age = parse_patient_age(demographics.get('PatientAge'))
+
+        phantom_group = None
+        age_source = None
+
+        if birth_date is not None and study_date is not None:
+            phantom_group = phantom_group_from_age(age_in_years(study_date, birth_date))
+            age_source = 'birth date'
+        elif entry['birth_date'] is not None and study_date is not None:
+            phantom_group = phantom_group_from_age(age_in_years(study_date, entry['birth_date']))
+            age_source = 'birth date from another study of the patient'
+        elif patient_age is not None:
+            phantom_group = phantom_group_from_age(patient_age)
+            age_source = 'PatientAge'
+        elif entry['ages'] and study_date is not None:
+            # Age at the closest other study, shifted by the time between the studies
+            other_date, other_age = min(entry['ages'], key=lambda item: abs((item[0] - study_date).days))
+            phantom_group = phantom_group_from_age(other_age + (study_date - other_date).days / 365.25)
+            age_source = 'PatientAge from another study of the patient'
+
+        if demographics.get('PatientSex') in PATIENT_SEX_CODES:
+            patient_sex = PATIENT_SEX_CODES[demographics['PatientSex']]
+            sex_source = 'RDSR'
+        elif entry['sex'] is not None:
+            patient_sex = PATIENT_SEX_CODES[entry['sex']]
+            sex_source = 'another study of the patient'
+        else:
+            patient_sex = 1 # Default to female
+            sex_source = 'default'
+
+        return phantom_group, patient_sex, {'phantom_group': age_source, 'patient_sex': sex_source}
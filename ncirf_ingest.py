@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Ingestion of NCIRF batch results
+
+Reads the organ dose output of NCIRF batch runs in bulk and joins every output row back to the
+irradiation event it was simulated for, using the event keys recorded in the job manifest written
+next to each NCIRF batch CSV. The manifests are read through the output sink the batches were written to
+(local directory, object store or spool directory). Organ doses are then summed per study and per patient
+for the dose registry; patients are identified by the DICOM PatientID recorded in the manifest. Studies whose batch left out irradiation events that failed validation are marked
+incomplete, since their sums miss the dose of those events.
+
+NCIRF returns one output row per batch input row, in the same order, so the row number links an
+output row to the manifest row and its event key. A study converted more than once (e.g. with other
+run settings) has a batch per job; only the newest one is ingested, so no event is counted twice. The newest
+job is chosen from all manifests in the batch sink, so a superseded batch is never ingested in its place.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from ncirf_jobs import read_job_manifest, manifest_path_for
+from ncirf_sinks import open_sink
+
+# Column of the NCIRF output echoing the patient ID of the batch input
+ID_COLUMN = 'ID'
+
+# Event columns carried into the joined results
+# patient_id is the DICOM PatientID of the study, None if the manifest does not record it, and ncirf_id the
+# patient ID entered for the batch. dropped_events is the number of events of the study left out of its batch,
+# NaN if the manifest does not record it.
+EVENT_COLUMNS = ['patient_id', 'ncirf_id', 'study_instance_uid', 'event_key', 'irradiation_event_uid', 'event_index', 'row', 'job_key',
+                 'created', 'dropped_events']
+
+# Function to read an NCIRF batch output file (CSV or Excel)
+def read_ncirf_output(output_path):
+
+    ext = os.path.splitext(output_path)[1].lower()
+
+    if ext == '.csv':
+        return pd.read_csv(output_path)
+    elif ext in ('.xlsx', '.xls'):
+        return pd.read_excel(output_path)
+    else:
+        raise ValueError(f'Unsupported NCIRF output format: {output_path}')
+
+# Function to find the NCIRF output file of every batch CSV that has a job manifest in the batch sink
+# The output of <name>.csv is expected in output_dir as <name><output_suffix>.csv or .xlsx
+# Returns a list of (batch CSV name, output path) pairs; batches without output yet are left out
+def find_batch_outputs(batch_sink, output_dir, output_suffix='_output'):
+
+    pairs = []
+
+    for name in batch_sink.list_names():
+        if not name.endswith('_manifest.json'):
+            continue
+
+        batch_name = name[:-len('_manifest.json')]
+
+        for ext in ('.csv', '.xlsx'):
+            output_path = os.path.join(output_dir, batch_name + output_suffix + ext)
+            if os.path.exists(output_path):
+                pairs.append((batch_name + '.csv', output_path))
+                break
+
+    return pairs
+
+# Function to pick the organ dose columns of an NCIRF output
+# organ_columns lists them explicitly; if it is None every numeric column is taken. Columns that are neither
+# organ doses, the ID column nor in ignore_columns are rejected, as are organ dose columns that are not numeric.
+def select_organ_columns(output, output_path, organ_columns=None, ignore_columns=()):
+
+    ignored = set(ignore_columns) | {ID_COLUMN}
+
+    if organ_columns is None:
+        organ_columns = [col for col in output.select_dtypes('number').columns if col not in ignored]
+    else:
+        missing = [col for col in organ_columns if col not in output.columns]
+        if missing:
+            raise ValueError(f'Organ dose columns missing from {output_path}: {missing}')
+
+    unexpected = [col for col in output.columns if col not in organ_columns and col not in ignored]
+    if unexpected:
+        raise ValueError(f'Unexpected columns in {output_path}: {unexpected}. Add them to organ_columns or ignore_columns.')
+
+    not_numeric = [col for col in organ_columns if not pd.api.types.is_numeric_dtype(output[col])]
+    if not_numeric:
+        raise ValueError(f'Organ dose columns of {output_path} are not numeric: {not_numeric}')
+
+    return list(organ_columns)
+
+# Function to return the creation time of a job manifest in UTC
+# Manifests written before the time was recorded in UTC hold the local time of the converting machine,
+# which is taken as the local time of this machine.
+def manifest_created(manifest):
+    return datetime.fromisoformat(manifest['created']).astimezone(timezone.utc)
+
+# Function to read the manifests of all batches in the batch sink and pick the newest job of every study
+# Returns a dict mapping the batch CSV name of the newest job of each study to its manifest.
+# Two jobs of a study created at the same time are rejected.
+def newest_batch_manifests(batch_sink, n_workers=8):
+
+    batch_names = [name[:-len('_manifest.json')] + '.csv' for name in batch_sink.list_names() if name.endswith('_manifest.json')]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        manifests = list(executor.map(lambda name: read_job_manifest(batch_sink, name), batch_names))
+
+    studies = {}
+
+    for batch_name, manifest in zip(batch_names, manifests):
+        studies.setdefault(manifest['input']['study_instance_uid'], []).append((manifest_created(manifest), batch_name, manifest))
+
+    newest = {}
+
+    for study_instance_uid, batches in studies.items():
+        batches.sort(key=lambda batch: batch[0], reverse=True)
+
+        if len(batches) > 1 and batches[0][0] == batches[1][0] and batches[0][2]['job_key'] != batches[1][2]['job_key']:
+            raise ValueError(f'Batches {batches[0][1]} and {batches[1][1]} of study {study_instance_uid} were created at the same time')
+
+        newest[batches[0][1]] = batches[0][2]
+
+    return newest
+
+# Function to join the NCIRF output of one batch to the irradiation events recorded in its manifest
+# The manifest is read from the batch sink unless it is given
+# Returns one row per simulated event with the event columns followed by the organ dose columns
+def load_batch_results(batch_sink, batch_csv_name, output_path, organ_columns=None, ignore_columns=(), manifest=None):
+
+    if manifest is None:
+        manifest = read_job_manifest(batch_sink, batch_csv_name)
+
+    if manifest is None:
+        raise FileNotFoundError(f'No job manifest {manifest_path_for(batch_csv_name)} found in the batch sink')
+
+    output = read_ncirf_output(output_path)
+
+    if len(output) != len(manifest['rows']):
+        raise ValueError(f"{output_path} has {len(output)} rows but {batch_csv_name} has {len(manifest['rows'])}")
+
+    events = pd.DataFrame(manifest['rows'])
+    events['patient_id'] = manifest['input'].get('patient_id')
+    events['ncirf_id'] = manifest['run_settings']['patient_id']
+    events['study_instance_uid'] = manifest['input']['study_instance_uid']
+    events['job_key'] = manifest['job_key']
+    events['created'] = manifest['created']
+    events['dropped_events'] = manifest.get('event_counts', {}).get('dropped', np.nan)
+
+    # The NCIRF ID column echoes the patient ID of the batch input
+    if ID_COLUMN in output and not (output[ID_COLUMN].to_numpy() == events['ncirf_id'].to_numpy()).all():
+        raise ValueError(f"Patient ID in {output_path} does not match {batch_csv_name}")
+
+    organ_columns = select_organ_columns(output, output_path, organ_columns, ignore_columns)
+
+    return pd.concat([events[EVENT_COLUMNS], output[organ_columns].reset_index(drop=True)], axis=1)
+
+# Function to load and join the results of many batches; the output files are read on a pool of n_workers threads
+# organ_columns and ignore_columns select the organ dose columns as in select_organ_columns
+# Only the pairs of the newest job of each study (see newest_batch_manifests) are read; a study whose newest
+# batch has no output yet is left out. Event keys that still occur twice are rejected.
+def ingest_batch_results(batch_sink, pairs, organ_columns=None, ignore_columns=(), n_workers=8):
+
+    manifests = newest_batch_manifests(batch_sink, n_workers)
+    pairs = [pair for pair in pairs if pair[0] in manifests]
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(lambda pair: load_batch_results(batch_sink, *pair, organ_columns, ignore_columns,
+                                                                    manifests[pair[0]]), pairs))
+
+    if not results:
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+
+    results = pd.concat(results, ignore_index=True)
+
+    duplicated = results['event_key'].duplicated()
+    if duplicated.any():
+        raise ValueError(f"Event keys occur in more than one output row: {results.loc[duplicated, 'event_key'].unique().tolist()}")
+
+    return results
+
+# Function to return the organ dose columns of the joined results
+def organ_dose_columns(results):
+    return [col for col in results.columns if col not in EVENT_COLUMNS]
+
+# Function to sum the organ doses of all events per study
+# A study is incomplete when events were dropped from its batch, or when its manifest does not record dropped events
+def aggregate_per_study(results):
+
+    organ_columns = organ_dose_columns(results)
+    grouped = results.groupby(['patient_id', 'study_instance_uid'], sort=True, dropna=False)
+
+    per_study = grouped[organ_columns].sum()
+    per_study.insert(0, 'event_count', grouped.size())
+    per_study.insert(1, 'dropped_event_count', grouped['dropped_events'].first())
+    per_study.insert(2, 'incomplete', ~(per_study['dropped_event_count'] == 0))
+
+    return per_study.reset_index()
+
+# Function to sum the organ doses of all studies per patient
+# incomplete_study_count counts the studies of the patient that are incomplete as in aggregate_per_study
+def aggregate_per_patient(results):
+
+    organ_columns = organ_dose_columns(results)
+    grouped = results.groupby('patient_id', sort=True, dropna=False)
+
+    studies = results.drop_duplicates(['patient_id', 'study_instance_uid']).assign(incomplete=lambda s: ~(s['dropped_events'] == 0))
+    study_grouped = studies.groupby('patient_id', sort=True, dropna=False)
+
+    per_patient = grouped[organ_columns].sum()
+    per_patient.insert(0, 'study_count', grouped['study_instance_uid'].nunique())
+    per_patient.insert(1, 'event_count', grouped.size())
+    per_patient.insert(2, 'dropped_event_count', study_grouped['dropped_events'].sum())
+    per_patient.insert(3, 'incomplete_study_count', study_grouped['incomplete'].sum())
+
+    return per_patient.reset_index()
+
+
+if __name__ == '__main__':
+
+    # Begin Main Processing block (protected by try-except)
+    try:
+
+        #   Please designate where the NCIRF batch CSVs were written with their manifests (a directory or an
+        #   output target such as 's3://bucket/prefix' or 'spool:///path/to/spool', see ncirf_sinks.open_sink),
+        #   the directory holding the NCIRF batch output and the directory for the registry files.
+        batch_target = "[Path to NCIRF batch CSVs]"
+        batch_endpoint_url = None
+        output_dir = "[Path to NCIRF batch output]"
+        registry_dir = "[Path to dose registry]"
+
+        #   Designate the organ dose columns of the NCIRF output, or None to take every numeric column.
+        #   Output columns that are not organ doses (e.g. echoed inputs) must be listed in ignore_columns.
+        organ_columns = None
+        ignore_columns = []
+
+        batch_sink = open_sink(batch_target, endpoint_url=batch_endpoint_url)
+
+        pairs = find_batch_outputs(batch_sink, output_dir)
+        print(f'Found NCIRF output for {len(pairs)} batches.')
+
+        results = ingest_batch_results(batch_sink, pairs, organ_columns, ignore_columns)
+
+        results.to_csv(os.path.join(registry_dir, 'organ_dose_per_event.csv'), index=False)
+        aggregate_per_study(results).to_csv(os.path.join(registry_dir, 'organ_dose_per_study.csv'), index=False)
+        aggregate_per_patient(results).to_csv(os.path.join(registry_dir, 'organ_dose_per_patient.csv'), index=False)
+
+    except Exception as e:
+        print(f"Error: {e}")
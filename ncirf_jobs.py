@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Run-settings profiles and job manifests for NCIRF batch generation
+
+A run profile (TOML, or YAML when PyYAML is installed) holds the settings that are otherwise
+entered interactively when the converter runs. A job manifest is written next to every NCIRF
+batch CSV and records the input hash, the profile, the code version, how each row was derived and the
+key of the irradiation event behind each row, so that a scheduler can skip regenerating or re-simulating identical jobs.
+It also lists the validation flags of every irradiation event of the input and whether its row was emitted,
+so that a CSV missing dropped events can be told apart from a complete one.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+# Settings a run profile may define. Any setting left out of the profile is asked for interactively.
+PROFILE_KEYS = ['patient_id', 'arm_position', 'phantom_group', 'iso_x', 'iso_y', 'iso_z', 'history_num', 'cpu_core_num']
+
+# Function to read a named run profile from a TOML or YAML file
+# The profile name defaults to the file name without extension
+def load_run_profile(profile_path):
+
+    ext = os.path.splitext(profile_path)[1].lower()
+
+    if ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError('tomli is required to read TOML run profiles before Python 3.11. Install it or use a YAML profile.')
+        with open(profile_path, 'rb') as f:
+            profile = tomllib.load(f)
+    elif ext in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('PyYAML is required to read YAML run profiles. Install it or use a TOML profile.')
+        with open(profile_path, 'r') as f:
+            profile = yaml.safe_load(f) or {}
+    else:
+        raise ValueError(f'Unsupported run profile format: {profile_path}')
+
+    unknown_keys = set(profile) - set(PROFILE_KEYS) - {'name'}
+    if unknown_keys:
+        raise ValueError(f'Unknown settings in run profile {profile_path}: {sorted(unknown_keys)}')
+
+    profile.setdefault('name', os.path.splitext(os.path.basename(profile_path))[0])
+
+    return profile
+
+# Function to take a run setting from the profile, or to ask for it when the profile does not define it
+# Returns the raw text so that the caller parses profile values and typed answers the same way
+def profile_or_input(run_profile, setting_sources, key, prompt):
+
+    if key in run_profile:
+        setting_sources[key] = 'profile'
+        return str(run_profile[key])
+
+    setting_sources[key] = 'prompt'
+    return input(prompt)
+
+# Function to calculate the SHA-256 hash of a file
+def file_sha256(path):
+
+    sha = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+# Function to describe the code that produces a job: the converter version and the SHA-256 of the converter
+# and of every module or data file that feeds its rows, its manifest or its CSV bytes
+def build_code_version(converter_path, version, dependency_paths):
+
+    return {
+        'converter': os.path.basename(converter_path),
+        'version': version,
+        'sha256': {os.path.basename(path): file_sha256(path) for path in [converter_path] + list(dependency_paths)},
+        }
+
+# Function to calculate the key identifying a job: the same input, settings and code give the same key
+def compute_job_key(input_sha256, run_settings, code_version):
+
+    payload = json.dumps({
+        'input_sha256': input_sha256,
+        'run_settings': run_settings,
+        'code_version': code_version,
+        }, sort_keys=True, default=str)
+
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# Function to return the manifest path belonging to an NCIRF batch CSV
+def manifest_path_for(csv_path):
+    return os.path.splitext(csv_path)[0] + '_manifest.json'
+
+# Function to read the manifest of an NCIRF batch CSV from an output sink. Returns None if there is none.
+def read_job_manifest(output_sink, csv_name):
+
+    manifest = output_sink.read(manifest_path_for(csv_name))
+
+    return json.loads(manifest) if manifest is not None else None
+
+# Function to check whether a CSV with the same job key has already been written to the output sink
+# Sinks that cannot read back their output under its own name (e.g. a spool directory) never report a job as current
+def is_job_current(output_sink, csv_name, job_key):
+
+    if not output_sink.exists(csv_name):
+        return False
+
+    manifest = read_job_manifest(output_sink, csv_name)
+
+    return manifest is not None and manifest.get('job_key') == job_key
+
+# Function to make the stable key of an irradiation event: the study instance UID and the irradiation event UID,
+# or the position of the event in the RDSR when the event has no UID
+def make_event_key(study_instance_uid, irradiation_event_uid, event_index):
+
+    if irradiation_event_uid:
+        return f'{study_instance_uid}/{irradiation_event_uid}'
+
+    return f'{study_instance_uid}/event-{event_index}'
+
+# Function to assemble the job manifest of an NCIRF batch CSV
+# row_derivations holds one entry per CSV row, in row order; each row is given the event key it was built from
+# event_validations holds one entry per irradiation event of the input with its 'event_index', 'irradiation_event_uid',
+# 'validation_flags' and whether it was 'dropped' or 'emitted'. Events neither dropped nor emitted have no DAP and are not simulated.
+# The batch is complete when no event was dropped.
+# dicom_patient_id is the PatientID (0010,0020) of the RDSR, unlike the patient_id of the run settings, which is entered per batch
+def build_job_manifest(job_key, input_path, input_sha256, study_instance_uid, dicom_patient_id, run_profile, run_settings, setting_sources,
+                       code_version, row_derivations, event_validations):
+
+    rows = []
+
+    for n, derivation in enumerate(row_derivations):
+        event_key = make_event_key(study_instance_uid, derivation.get('irradiation_event_uid'), derivation.get('event_index'))
+        rows.append(dict(derivation, row=n, event_key=event_key))
+
+    events = []
+
+    for validation in event_validations:
+        event_key = make_event_key(study_instance_uid, validation.get('irradiation_event_uid'), validation.get('event_index'))
+        events.append(dict(validation, event_key=event_key))
+
+    event_counts = {
+        'events': len(events),
+        'emitted': sum(bool(event['emitted']) for event in events),
+        'dropped': sum(bool(event['dropped']) for event in events),
+        }
+    event_counts['not_simulated'] = event_counts['events'] - event_counts['emitted'] - event_counts['dropped']
+
+    return {
+        'job_key': job_key,
+        'created': datetime.now(timezone.utc).isoformat(timespec='microseconds'),
+        'input': {
+            'file_name': os.path.basename(input_path),
+            'sha256': input_sha256,
+            'study_instance_uid': study_instance_uid,
+            'patient_id': dicom_patient_id,
+            },
+        'profile': run_profile,
+        'run_settings': run_settings,
+        'setting_sources': setting_sources,
+        'code_version': code_version,
+        'rows': rows,
+        'event_counts': event_counts,
+        'complete': event_counts['dropped'] == 0,
+        'events': events,
+        }
+
+# Function to write the job manifest next to its NCIRF batch CSV in the output sink
+def write_job_manifest(output_sink, csv_name, manifest):
+
+    manifest_name = manifest_path_for(csv_name)
+    output_sink.write(manifest_name, json.dumps(manifest, indent=2, default=str))
+
+    return manifest_name
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Output sinks for NCIRF batch CSVs and their job manifests
+
+A sink receives named outputs and buffers them until batch_size outputs are pending, then writes them
+in one batch. Sinks are available for a local directory, a local directory written atomically
+(temporary file, then rename), an S3-compatible object store and a spool directory watched by the
+NCIRF scheduler. open_sink() picks the sink from a target such as 's3://bucket/prefix'.
+InMemoryObjectStoreClient stands in for an object store client when no server is at hand.
+"""
+
+import csv
+import io
+from abc import ABC, abstractmethod
+import os
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+# Function to encode NCIRF rows as CSV
+# Lines end as in a text-mode file written on this platform, like the converter has always written them
+def rows_to_csv_bytes(rows):
+
+    buffer = io.StringIO()
+    fc = csv.writer(buffer, lineterminator=os.linesep)
+    fc.writerows(rows)
+
+    return buffer.getvalue().encode('utf-8')
+
+
+# Base class of the output sinks: buffers the outputs and writes them in batches
+# A sink defines write_one; it cannot be created otherwise
+class OutputSink(ABC):
+
+    def __init__(self, batch_size=1):
+        self.batch_size = batch_size
+        self.buffer = []
+
+    # Function to queue an output; the pending outputs are written once batch_size of them are queued
+    def write(self, name, data):
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        self.buffer.append((name, data))
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    # Function to write all pending outputs, in the order they were queued
+    def flush(self):
+
+        if self.buffer:
+            batch, self.buffer = self.buffer, []
+            self.write_batch(batch)
+
+    def write_batch(self, batch):
+        for name, data in batch:
+            self.write_one(name, data)
+
+    @abstractmethod
+    def write_one(self, name, data):
+        pass
+
+    # Function to read a written output. Returns None if the sink cannot read it back or it does not exist.
+    def read(self, name):
+        return None
+
+    # Function to list the names of the outputs that can be read back, sorted
+    def list_names(self):
+        return []
+
+    def exists(self, name):
+        return self.read(name) is not None
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    # Pending outputs are discarded if the block raised, so that no partial set of outputs is written
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.buffer = []
+
+
+# Sink writing every output as a file in a local directory
+class LocalFileSink(OutputSink):
+
+    def __init__(self, directory, batch_size=1):
+        super().__init__(batch_size)
+        self.directory = directory
+
+    def path_for(self, name):
+        return os.path.join(self.directory, name)
+
+    def write_one(self, name, data):
+        with open(self.path_for(name), 'wb') as f:
+            f.write(data)
+
+    def read(self, name):
+
+        if not os.path.exists(self.path_for(name)):
+            return None
+
+        with open(self.path_for(name), 'rb') as f:
+            return f.read()
+
+    def exists(self, name):
+        return os.path.exists(self.path_for(name))
+
+    def list_names(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if not name.startswith('.') and os.path.isfile(self.path_for(name)))
+
+
+# Sink writing every output to a temporary file first and renaming it, so readers never see a partial file
+class AtomicFileSink(LocalFileSink):
+
+    def write_one(self, name, data):
+
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.' + name + '.', suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path_for(name))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+# Sink handing every output to the spool directory of the NCIRF scheduler
+# A batch is written to spool_dir/tmp and moved to spool_dir/new once complete, every output of the batch under
+# the same job id prefix (job_id, or a new unique id per batch), so the scheduler only picks up complete files
+# and can pair a CSV with its manifest. Manifests are published before the CSVs they describe.
+# Published outputs can be listed and read back under their spool names until the scheduler consumes them.
+class SpoolSink(OutputSink):
+
+    def __init__(self, spool_dir, batch_size=1, job_id=None):
+        super().__init__(batch_size)
+        self.tmp_dir = os.path.join(spool_dir, 'tmp')
+        self.new_dir = os.path.join(spool_dir, 'new')
+        self.job_id = job_id
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.new_dir, exist_ok=True)
+
+    def write_one(self, name, data):
+        self.write_batch([(name, data)])
+
+    def write_batch(self, batch):
+
+        job_id = self.job_id or uuid.uuid4().hex
+        spool_names = []
+
+        for name, data in batch:
+            spool_name = f'{job_id}_{name}'
+
+            with open(os.path.join(self.tmp_dir, spool_name), 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+            spool_names.append(spool_name)
+
+        for spool_name in sorted(spool_names, key=lambda spool_name: not spool_name.endswith('_manifest.json')):
+            os.replace(os.path.join(self.tmp_dir, spool_name), os.path.join(self.new_dir, spool_name))
+
+    def read(self, name):
+
+        if not os.path.isfile(os.path.join(self.new_dir, name)):
+            return None
+
+        with open(os.path.join(self.new_dir, name), 'rb') as f:
+            return f.read()
+
+    def list_names(self):
+        return sorted(os.listdir(self.new_dir))
+
+
+# Function to tell whether an object store error means that the object does not exist
+def is_missing_object_error(error):
+
+    if isinstance(error, (KeyError, FileNotFoundError)):
+        return True
+
+    error_code = getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+    return error_code in ('NoSuchKey', 'NotFound', '404')
+
+
+# Sink uploading every output to an S3-compatible object store
+# client is any object with the put_object/get_object/head_object/list_objects_v2 calls of a boto3 S3 client, e.g. one
+# pointed at a local MinIO server with endpoint_url. A batch is uploaded on max_concurrency threads.
+class ObjectStoreSink(OutputSink):
+
+    def __init__(self, bucket, prefix='', client=None, endpoint_url=None, batch_size=1, max_concurrency=8):
+        super().__init__(batch_size)
+
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise ImportError('boto3 is required to write to an object store. Install it or pass an S3-compatible client.')
+            client = boto3.client('s3', endpoint_url=endpoint_url)
+
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.max_concurrency = max_concurrency
+
+    def key_for(self, name):
+        return f'{self.prefix}/{name}' if self.prefix else name
+
+    def write_one(self, name, data):
+        self.client.put_object(Bucket=self.bucket, Key=self.key_for(name), Body=data)
+
+    def write_batch(self, batch):
+
+        if len(batch) == 1 or self.max_concurrency <= 1:
+            super().write_batch(batch)
+            return
+
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batch))) as executor:
+            list(executor.map(lambda item: self.write_one(*item), batch))
+
+    def read(self, name):
+
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.key_for(name))['Body'].read()
+        except Exception as e:
+            if is_missing_object_error(e):
+                return None
+            raise
+
+    def exists(self, name):
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key_for(name))
+            return True
+        except Exception as e:
+            if is_missing_object_error(e):
+                return False
+            raise
+
+    def list_names(self):
+
+        key_prefix = self.key_for('')
+        names = []
+        kwargs = {'Bucket': self.bucket, 'Prefix': key_prefix}
+
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            names.extend(item['Key'][len(key_prefix):] for item in response.get('Contents', []))
+
+            if not response.get('IsTruncated'):
+                return sorted(names)
+
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+# Error raised by InMemoryObjectStoreClient, shaped like the ClientError of boto3
+class ObjectStoreClientError(Exception):
+
+    def __init__(self, code, operation_name):
+        super().__init__(f'An error occurred ({code}) when calling the {operation_name} operation')
+        self.response = {'Error': {'Code': code}}
+
+
+# In-memory stand-in for an S3-compatible client, e.g. for dry runs and tests of ObjectStoreSink
+# Implements the put_object/get_object/head_object/list_objects_v2 calls used by the sink; objects are kept in self.objects
+class InMemoryObjectStoreClient:
+
+    def __init__(self, page_size=1000):
+        self.objects = {}
+        self.page_size = page_size
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = bytes(Body)
+        return {}
+
+    def get_object(self, Bucket, Key):
+
+        if (Bucket, Key) not in self.objects:
+            raise ObjectStoreClientError('NoSuchKey', 'GetObject')
+
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)]), 'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def head_object(self, Bucket, Key):
+
+        if (Bucket, Key) not in self.objects:
+            raise ObjectStoreClientError('404', 'HeadObject')
+
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None):
+
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        page = keys[start:start + self.page_size]
+        response = {'Contents': [{'Key': key} for key in page], 'KeyCount': len(page),
+                    'IsTruncated': start + self.page_size < len(keys)}
+
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(start + self.page_size)
+
+        return response
+
+
+# Function to open the sink for an output target:
+#   's3://bucket/prefix'     S3-compatible object store (endpoint_url selects MinIO and the like)
+#   'spool:///path/to/dir'   spool directory of the NCIRF scheduler ('spool://dir' for a relative path)
+#   'atomic:///path/to/dir'  local directory, written atomically ('atomic://dir' for a relative path)
+#   '/path/to/dir'           local directory
+# job_id names the outputs of a spool directory; other sinks keep the output names
+def open_sink(target, batch_size=1, endpoint_url=None, client=None, job_id=None):
+
+    parsed = urlparse(target)
+    local_path = parsed.netloc + parsed.path
+
+    if parsed.scheme == 's3':
+        return ObjectStoreSink(parsed.netloc, parsed.path, client=client, endpoint_url=endpoint_url, batch_size=batch_size)
+    elif parsed.scheme == 'spool':
+        return SpoolSink(local_path, batch_size, job_id)
+    elif parsed.scheme == 'atomic':
+        return AtomicFileSink(local_path, batch_size)
+    else:
+        return LocalFileSink(target, batch_size)
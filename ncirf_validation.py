@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Consistency validation of irradiation events before NCIRF batch rows are emitted
+
+All events of a batch, or of a chunk of it, are checked at once on a DataFrame. Each event is flagged for missing parameters,
+beams outside the NCIRF range or the HVL database, unsupported or non-flat filters, physically implausible
+geometry and collimated field sizes that do not agree with DAP / Dose (RP), so that such rows can be
+reported or dropped before they are simulated. Events carrying one of the BLOCKING_FLAGS cannot be
+converted by build_ncirf_row at all and are never passed to it.
+"""
+
+import numpy as np
+import pandas as pd
+
+# kVp range covered by the NCIRF beam qualities (after rounding to 10 kV)
+NCIRF_KVP_RANGE = (50, 120)
+
+# kVp and copper filter thickness (mm) range covered by hvl_copper_filter.xlsx; the HVL is not extrapolated
+HVL_DATABASE_KVP_RANGE = (50, 125)
+HVL_DATABASE_THICKNESS_RANGE = (0.0, 0.9)
+
+# Plausible source to isocenter distance in mm
+SID_RANGE = (300, 1500)
+
+# Allowed relative difference between the collimated field area and DAP / Dose (RP) at the reference point
+FIELD_SIZE_TOLERANCE = 0.5
+
+# Parameters build_ncirf_row reads from every simulated event
+REQUIRED_PARAMETERS = ['Dose Area Product', 'KVP', 'X-Ray Filter Material', 'X-Ray Filter Thickness Minimum',
+                       'X-Ray Filter Thickness Maximum', 'Distance Source to Isocenter', 'Distance Source to Detector',
+                       'Positioner Primary Angle', 'Positioner Secondary Angle']
+
+# Names of the validation flags, in reporting order
+VALIDATION_FLAGS = ['missing_parameters', 'kvp_out_of_range', 'filter_not_supported', 'filter_not_flat', 'zero_distance',
+                    'no_field_size', 'implausible_geometry', 'field_size_dap_mismatch']
+
+# Flags of events that build_ncirf_row cannot convert
+BLOCKING_FLAGS = ['missing_parameters', 'kvp_out_of_range', 'filter_not_supported', 'filter_not_flat', 'zero_distance',
+                  'no_field_size']
+
+# Function to choose how build_ncirf_row derives the field size of an irradiation event
+# Returns 'width_height', 'area' or 'dap_dose_rp', or None when the parameters of that derivation are missing or not positive
+def field_size_method(i):
+
+    if 'Collimated Field Area' not in i:
+        return None
+
+    has_width_height = 'Collimated Field Height' in i and 'Collimated Field Width' in i
+
+    if i['Collimated Field Area'] == 0 or (has_width_height and (i['Collimated Field Height'] == 0 or i['Collimated Field Width'] == 0)):
+        method = 'dap_dose_rp'
+    elif has_width_height:
+        method = 'width_height'
+    else:
+        method = 'area'
+
+    if method == 'dap_dose_rp' and not (i.get('Dose (RP)', 0) != 0 and i.get('Dose Area Product', 0) / i['Dose (RP)'] > 0):
+        return None
+
+    if method == 'area' and not i['Collimated Field Area'] > 0:
+        return None
+
+    return method
+
+# Function to return a numeric column of the event table, or NaN when no event reports the parameter
+def numeric_column(events, name):
+    if name in events:
+        return pd.to_numeric(events[name], errors='coerce')
+    return pd.Series(np.nan, index=events.index)
+
+# Function to validate the parameter dictionaries of all irradiation events of a batch
+# Returns a DataFrame with one row per event: a column per flag, 'invalid' (any flag), 'unconvertible'
+# (any blocking flag) and a 'validation_flags' summary. Events without DAP are not simulated and are never flagged.
+def validate_events(dict_all_series, field_size_tolerance=FIELD_SIZE_TOLERANCE):
+
+    events = pd.DataFrame.from_records(dict_all_series, index=pd.RangeIndex(len(dict_all_series)))
+
+    kvp = numeric_column(events, 'KVP')
+    sid = numeric_column(events, 'Distance Source to Isocenter')
+    sdd = numeric_column(events, 'Distance Source to Detector')
+    srd = numeric_column(events, 'Distance Source to Reference Point').fillna(sid - 150)
+    dap = numeric_column(events, 'Dose Area Product')
+    dose_rp = numeric_column(events, 'Dose (RP)')
+    width = numeric_column(events, 'Collimated Field Width')
+    height = numeric_column(events, 'Collimated Field Height')
+    area = numeric_column(events, 'Collimated Field Area')
+    flt_min = numeric_column(events, 'X-Ray Filter Thickness Minimum')
+    flt_max = numeric_column(events, 'X-Ray Filter Thickness Maximum')
+
+    if 'X-Ray Filter Material' in events:
+        flt_material = events['X-Ray Filter Material'].astype(str).str.lower()
+    else:
+        flt_material = pd.Series('', index=events.index)
+
+    simulated = (dap != 0).to_numpy()
+
+    flags = pd.DataFrame(index=events.index)
+
+    flags['missing_parameters'] = events.reindex(columns=REQUIRED_PARAMETERS).isna().any(axis=1)
+
+    kvp_ncirf = (kvp / 10).round() * 10
+    flags['kvp_out_of_range'] = ~(kvp_ncirf.between(*NCIRF_KVP_RANGE) & kvp.between(*HVL_DATABASE_KVP_RANGE))
+
+    flags['filter_not_supported'] = ~(flt_material.str.contains('copper') & flt_min.between(*HVL_DATABASE_THICKNESS_RANGE))
+
+    flags['filter_not_flat'] = ~(flt_min == flt_max)
+
+    flags['zero_distance'] = (sdd == 0) | (srd == 0)
+
+    flags['implausible_geometry'] = ~(sid.between(*SID_RANGE) & (sdd > sid) & (srd > 0) & (srd <= sid))
+
+    # Field size derivation of each event, chosen with the same conditions as build_ncirf_row
+    method = pd.Series([field_size_method(i) for i in dict_all_series], index=events.index, dtype=object)
+
+    # Field area at the reference point (cm^2) from DAP (Gy*m^2) / Dose (RP) (Gy)
+    dap_area = dap / dose_rp.replace(0, np.nan) * 10000
+
+    # Collimated field area at the detector (cm^2): width/height in mm, area in m^2.
+    # Events whose field size is derived from DAP / Dose (RP) have nothing to compare against.
+    collimated_area = pd.Series(np.select([method == 'width_height', method == 'area'],
+                                          [width * height / 100, area * 10000], np.nan), index=events.index)
+    collimated_area_rp = collimated_area * (srd / sdd) ** 2
+
+    flags['field_size_dap_mismatch'] = (collimated_area_rp / dap_area - 1).abs() > field_size_tolerance
+    flags['no_field_size'] = method.isna()
+
+    flags = flags[VALIDATION_FLAGS]
+    flags.loc[~simulated] = False
+
+    flags['invalid'] = flags[VALIDATION_FLAGS].any(axis=1)
+    flags['unconvertible'] = flags[BLOCKING_FLAGS].any(axis=1)
+
+    summary = pd.Series('', index=events.index)
+    for name in VALIDATION_FLAGS:
+        summary = summary + np.where(flags[name], name + ';', '')
+    flags['validation_flags'] = summary.str.rstrip(';')
+
+    return flags
+
+# Function to count the flagged events per validation flag
+def summarize_validation(flags):
+    return {name: int(flags[name].sum()) for name in VALIDATION_FLAGS + ['invalid', 'unconvertible']}
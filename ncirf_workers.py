@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Worker processes of the converter scripts
+
+Converter scripts such as DICOMtoNCIRF_V4.1_annotated.py cannot be imported by their file name, so a
+worker process started by spawn or forkserver cannot unpickle their functions. The pool initializer here
+loads the converter from its file, under the module name it has in the parent process, before the worker
+is sent any work. Under fork the worker inherits the module and nothing is loaded again.
+"""
+
+import importlib.util
+import sys
+
+# Function to load a module from its file under module_name, unless a module of that name is loaded already
+def load_module(module_name, module_path):
+
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+
+    return module
+
+# Function to initialize a worker process: load the module and call its initializer_name with initargs
+def init_worker(module_name, module_path, initializer_name, initargs=()):
+    getattr(load_module(module_name, module_path), initializer_name)(*initargs)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Differential regression and benchmark harness for DICOM-to-NCIRF converters
+
+Runs two converter implementations over a corpus of synthetic or de-identified RDSRs in parallel,
+diffs the NCIRF rows column by column within tolerances and reports the throughput of each converter.
+A converter is any script defining convert_rdsr(dicom_file_path, run_settings) that returns the
+NCIRF batch rows, e.g. DICOMtoNCIRF_V2.py or DICOMtoNCIRF_V4.1_annotated.py. Without a corpus of
+real RDSRs, a synthetic corpus is generated with synthetic_rdsr.py. benchmark_event_workers measures
+how a converter that converts the events of a study on a worker pool scales with the number of workers.
+"""
+
+import glob
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from ncirf_workers import load_module
+from synthetic_rdsr import write_synthetic_corpus
+
+# Labels of the NCIRF batch input columns, in the order written by the converter (the CSV has no header)
+NCIRF_INPUT_COLUMNS = ['ID', 'Arm', 'Age', 'Sex', 'kVp', 'HVL', 'SID', 'Field Width', 'Field Height', 'DAP',
+                       'PPA', 'PSA', 'Iso X', 'Iso Y', 'Iso Z', 'History', 'Threads']
+
+# Default absolute and relative tolerance applied to every numeric column
+DEFAULT_TOLERANCE = {'atol': 1e-9, 'rtol': 1e-6}
+
+# Function to load a converter script by path
+# File names such as DICOMtoNCIRF_V4.1_annotated.py cannot be imported by name. Cached per process.
+# The module is registered in sys.modules so that its functions can be pickled to the worker pool of
+# convert_rdsr(..., n_workers > 1); workers started by fork inherit the registration and workers started by
+# spawn or forkserver load the script under the same name (see ncirf_workers).
+@lru_cache(maxsize=None)
+def load_converter(converter_path):
+
+    module_name = os.path.splitext(os.path.basename(converter_path))[0].replace('.', '_')
+    module = load_module(module_name, os.path.abspath(converter_path))
+
+    if not hasattr(module, 'convert_rdsr'):
+        raise AttributeError(f'{converter_path} does not define convert_rdsr(dicom_file_path, run_settings)')
+
+    return module
+
+# Function to convert one RDSR with a converter (unit of work of the worker pool)
+# converter_options are passed to convert_rdsr as keyword arguments, e.g. {'n_workers': 4} for V4.1
+# Returns the rows, the wall-clock and CPU time of the conversion in seconds and the error message if the conversion failed.
+# The CPU time is that of the calling process; time spent in worker pools of the converter is not included.
+def run_converter(converter_path, dicom_path, run_settings, converter_options=None):
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    try:
+        rows = load_converter(converter_path).convert_rdsr(dicom_path, run_settings, **(converter_options or {}))
+        error = None
+    except Exception as e:
+        rows = []
+        error = f'{type(e).__name__}: {e}'
+
+    return rows, time.perf_counter() - start, time.process_time() - cpu_start, error
+
+# Function to convert a corpus of RDSRs with one converter on a pool of n_workers processes
+# Returns the per-file results in corpus order and the wall-clock time of the whole corpus
+def run_corpus(converter_path, dicom_paths, run_settings, n_workers=1, converter_options=None):
+
+    start = time.perf_counter()
+
+    if n_workers <= 1:
+        results = [run_converter(converter_path, dicom_path, run_settings, converter_options) for dicom_path in dicom_paths]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(run_converter, [converter_path] * len(dicom_paths), dicom_paths,
+                                        [run_settings] * len(dicom_paths), [converter_options] * len(dicom_paths)))
+
+    return results, time.perf_counter() - start
+
+# Function to turn NCIRF rows into a DataFrame with the NCIRF batch column names
+# Rows shorter than the longest row are padded with missing values
+def rows_to_frame(rows):
+
+    if not rows:
+        return pd.DataFrame(columns=NCIRF_INPUT_COLUMNS)
+
+    frame = pd.DataFrame([list(row) for row in rows])
+    frame.columns = NCIRF_INPUT_COLUMNS[:frame.shape[1]] + [f'Column {n}' for n in range(len(NCIRF_INPUT_COLUMNS), frame.shape[1])]
+
+    return frame
+
+# Function to diff the NCIRF rows of a reference and a candidate converter column by column
+# tolerances maps column names to {'atol': ..., 'rtol': ...}; other numeric columns use DEFAULT_TOLERANCE.
+# Values missing on both sides are equal.
+# Returns one row per mismatching value; a differing row count is reported as a mismatch of column 'rows'.
+# Rows of different lengths (e.g. V2 leaves out values in some branches) cannot be aligned column by column;
+# each is reported as a mismatch of column 'row_length' and its values are not compared.
+def diff_rows(reference_rows, candidate_rows, tolerances=None, ignore_columns=()):
+
+    tolerances = tolerances or {}
+
+    if len(reference_rows) != len(candidate_rows):
+        return pd.DataFrame([{'row': None, 'column': 'rows', 'reference': len(reference_rows), 'candidate': len(candidate_rows)}])
+
+    mismatches = []
+    compared_rows = []
+
+    for row, (ref_row, cand_row) in enumerate(zip(reference_rows, candidate_rows)):
+        if len(ref_row) == len(cand_row):
+            compared_rows.append(row)
+        else:
+            mismatches.append({'row': row, 'column': 'row_length', 'reference': len(ref_row), 'candidate': len(cand_row)})
+
+    reference = rows_to_frame([reference_rows[row] for row in compared_rows])
+    candidate = rows_to_frame([candidate_rows[row] for row in compared_rows])
+
+    for column in reference.columns:
+        if column in ignore_columns:
+            continue
+
+        ref_values = pd.to_numeric(reference[column], errors='coerce').to_numpy(dtype=float)
+        cand_values = pd.to_numeric(candidate[column], errors='coerce').to_numpy(dtype=float)
+
+        tolerance = dict(DEFAULT_TOLERANCE, **tolerances.get(column, {}))
+        numeric = ~np.isnan(ref_values) & ~np.isnan(cand_values)
+
+        same = np.where(numeric,
+                        np.isclose(ref_values, cand_values, atol=tolerance['atol'], rtol=tolerance['rtol']),
+                        reference[column].astype(str).to_numpy() == candidate[column].astype(str).to_numpy())
+        same |= (reference[column].isna() & candidate[column].isna()).to_numpy()
+
+        for k in np.flatnonzero(~same):
+            mismatches.append({'row': compared_rows[k], 'column': column,
+                               'reference': reference[column].iat[k], 'candidate': candidate[column].iat[k]})
+
+    return pd.DataFrame(mismatches, columns=['row', 'column', 'reference', 'candidate'])
+
+# Function to run a reference and a candidate converter over a corpus and compare their output
+# The same converter can be compared against itself with different options, e.g. sequential and parallel events.
+# Returns the mismatches of all files and a throughput summary of both converters
+def compare_converters(reference_path, candidate_path, dicom_paths, run_settings, n_workers=1, tolerances=None, ignore_columns=(),
+                       reference_options=None, candidate_options=None):
+
+    reference_results, reference_wall = run_corpus(reference_path, dicom_paths, run_settings, n_workers, reference_options)
+    candidate_results, candidate_wall = run_corpus(candidate_path, dicom_paths, run_settings, n_workers, candidate_options)
+
+    mismatches = []
+
+    for dicom_path, (ref_rows, _, _, ref_error), (cand_rows, _, _, cand_error) in zip(dicom_paths, reference_results, candidate_results):
+        if ref_error or cand_error:
+            file_diff = pd.DataFrame([{'row': None, 'column': 'error', 'reference': ref_error, 'candidate': cand_error}])
+        else:
+            # An error in the diff of one file is reported like a conversion error instead of stopping the corpus
+            try:
+                file_diff = diff_rows(ref_rows, cand_rows, tolerances, ignore_columns)
+            except Exception as e:
+                file_diff = pd.DataFrame([{'row': None, 'column': 'diff_error', 'reference': None, 'candidate': f'{type(e).__name__}: {e}'}])
+        file_diff.insert(0, 'file', os.path.basename(dicom_path))
+        mismatches.append(file_diff)
+
+    throughput = []
+
+    for converter_path, options, results, wall in ((reference_path, reference_options, reference_results, reference_wall),
+                                                   (candidate_path, candidate_options, candidate_results, candidate_wall)):
+        row_count = sum(len(rows) for rows, _, _, _ in results)
+        throughput.append({
+            'converter': os.path.basename(converter_path),
+            'options': options or {},
+            'files': len(results),
+            'failed_files': sum(error is not None for _, _, _, error in results),
+            'rows': row_count,
+            'wall_time_s': wall,
+            'file_time_s': sum(seconds for _, seconds, _, _ in results),
+            'cpu_time_s': sum(cpu_seconds for _, _, cpu_seconds, _ in results),
+            'files_per_s': len(results) / wall if wall else np.nan,
+            'rows_per_s': row_count / wall if wall else np.nan,
+            })
+
+    return pd.concat(mismatches, ignore_index=True) if mismatches else pd.DataFrame(), pd.DataFrame(throughput)
+
+# Function to measure how the conversion of a corpus scales with the number of event workers of a converter
+# Files are converted one after another so that only the event worker pool of convert_rdsr runs in parallel.
+# Returns one row per number of workers with the wall time, the event rows per second and the speed-up over one worker
+def benchmark_event_workers(converter_path, dicom_paths, run_settings, worker_counts=(1, 2, 4), chunk_size=200):
+
+    benchmark = []
+
+    for n_workers in worker_counts:
+        results, wall = run_corpus(converter_path, dicom_paths, run_settings, 1, {'n_workers': n_workers, 'chunk_size': chunk_size})
+        row_count = sum(len(rows) for rows, _, _, _ in results)
+        benchmark.append({
+            'n_workers': n_workers,
+            'failed_files': sum(error is not None for _, _, _, error in results),
+            'rows': row_count,
+            'wall_time_s': wall,
+            'rows_per_s': row_count / wall if wall else np.nan,
+            })
+
+    benchmark = pd.DataFrame(benchmark)
+    benchmark['speedup'] = benchmark['wall_time_s'].iloc[0] / benchmark['wall_time_s']
+
+    return benchmark
+
+
+if __name__ == '__main__':
+
+    # Begin Main Processing block (protected by try-except)
+    try:
+
+        #   Please designate the two converters to compare and the directory of the RDSR corpus.
+        #   Leave corpus_dir empty to compare them on a synthetic corpus generated in a temporary directory.
+        reference_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DICOMtoNCIRF_V2.py')
+        candidate_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DICOMtoNCIRF_V4.1_annotated.py')
+        corpus_dir = "[Path to RDSR corpus]"
+
+        #   Settings otherwise entered interactively, shared by every file of the corpus
+        run_settings = {
+            'patient_id': 100001,
+            'arm_position': 1,
+            'iso_x': '',
+            'iso_y': '',
+            'iso_z': '',
+            'history_num': 1000000,
+            'cpu_core_num': 8,
+            }
+
+        #   Columns that differ by design between the converters are left out of the comparison
+        ignore_columns = ['ID', 'Iso X', 'Iso Y', 'Iso Z', 'History', 'Threads']
+        tolerances = {'SID': {'atol': 1e-6}, 'Field Width': {'atol': 1e-3}, 'Field Height': {'atol': 1e-3}}
+
+        n_workers = os.cpu_count()
+
+        if not corpus_dir:
+            corpus_dir = tempfile.mkdtemp(prefix='ncirf_corpus_')
+            write_synthetic_corpus(corpus_dir, n_files=20, n_events=200)
+
+        dicom_paths = sorted(glob.glob(os.path.join(corpus_dir, '*.dcm')))
+
+        mismatches, throughput = compare_converters(reference_path, candidate_path, dicom_paths, run_settings,
+                                                    n_workers, tolerances, ignore_columns)
+
+        print(throughput.to_string(index=False))
+
+        if len(mismatches):
+            print(f"{len(mismatches)} mismatching values in {mismatches['file'].nunique()} of {len(dicom_paths)} files:")
+            print(mismatches.groupby('column').size().to_string())
+            mismatches.to_csv(os.path.join(corpus_dir, 'regression_mismatches.csv'), index=False)
+        else:
+            print(f'No mismatches in {len(dicom_paths)} files.')
+
+    except Exception as e:
+        print(f"Error: {e}")
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic X-ray radiation dose SRs (RDSR) for tests and benchmarks
+
+Writes RDSRs with the content tree the converters read: one 'Irradiation Event X-Ray Data' container
+per irradiation event with the kVp, copper filter, geometry, collimation, dose and positioner items.
+Parameters are drawn from a seeded generator so that a corpus can be reproduced exactly. The collimated
+field area at the reference point agrees with DAP / Dose (RP), so the events pass validation.
+"""
+
+import os
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+# SOP class of X-Ray Radiation Dose SR Storage
+RDSR_SOP_CLASS_UID = '1.2.840.10008.5.1.4.1.1.88.67'
+
+# Copper filter thicknesses (mm) covered by hvl_copper_filter.xlsx
+COPPER_THICKNESSES = [0.0, 0.1, 0.2, 0.3, 0.6, 0.9]
+
+# Function to make a coded concept
+def code_item(meaning, value='', scheme='DCM'):
+
+    code = Dataset()
+    code.CodeValue = value or meaning[:16]
+    code.CodingSchemeDesignator = scheme
+    code.CodeMeaning = meaning
+
+    return code
+
+# Function to make a content item of the given value type with the concept name meaning
+def content_item(value_type, meaning):
+
+    item = Dataset()
+    item.RelationshipType = 'CONTAINS'
+    item.ValueType = value_type
+    item.ConceptNameCodeSequence = [code_item(meaning)]
+
+    return item
+
+def num_item(meaning, value, unit):
+
+    measured_value = Dataset()
+    measured_value.MeasurementUnitsCodeSequence = [code_item(unit, scheme='UCUM')]
+    measured_value.NumericValue = f'{value:.10g}'
+
+    item = content_item('NUM', meaning)
+    item.MeasuredValueSequence = [measured_value]
+
+    return item
+
+def code_value_item(meaning, value_meaning):
+
+    item = content_item('CODE', meaning)
+    item.ConceptCodeSequence = [code_item(value_meaning)]
+
+    return item
+
+def text_item(meaning, text):
+
+    item = content_item('TEXT', meaning)
+    item.TextValue = text
+
+    return item
+
+def uid_item(meaning, uid):
+
+    item = content_item('UIDREF', meaning)
+    item.UID = uid
+
+    return item
+
+def datetime_item(meaning, value):
+
+    item = content_item('DATETIME', meaning)
+    item.DateTime = value
+
+    return item
+
+def container_item(meaning, children):
+
+    item = content_item('CONTAINER', meaning)
+    item.ContinuityOfContent = 'SEPARATE'
+    item.ContentSequence = children
+
+    return item
+
+# Function to make the content item of one irradiation event with parameters drawn from rng
+# Every fifth event reports only the collimated field area, without width and height
+def irradiation_event_item(rng, event_index, study_date, uid_seed):
+
+    kvp = float(rng.integers(60, 111))
+    thickness = float(rng.choice(COPPER_THICKNESSES))
+    sid = float(rng.integers(700, 801))
+    srd = sid - 150
+    sdd = float(rng.integers(900, 1201))
+    width = float(rng.integers(100, 251))
+    height = float(rng.integers(100, 251))
+    area = width * height / 1e6 # m^2 at the detector
+    dap = float(rng.uniform(1e-5, 1e-3)) # Gy*m^2
+    dose_rp = dap / (area * (srd / sdd) ** 2)
+    seconds = event_index * 7
+
+    children = [
+        uid_item('Irradiation Event UID', generate_uid(entropy_srcs=[uid_seed, str(event_index)])),
+        datetime_item('DateTime Started', f'{study_date}{8 + seconds // 3600:02d}{seconds // 60 % 60:02d}{seconds % 60:02d}.000'),
+        code_value_item('Irradiation Event Type', 'Fluoroscopy'),
+        code_value_item('Acquisition Plane', 'Single Plane'),
+        code_value_item('Target Region', 'Chest'),
+        text_item('Device Name', 'SYNTHETIC'),
+        num_item('Dose Area Product', dap, 'Gy.m2'),
+        num_item('Dose (RP)', dose_rp, 'Gy'),
+        num_item('Positioner Primary Angle', float(rng.integers(-90, 91)), 'deg'),
+        num_item('Positioner Secondary Angle', float(rng.integers(-40, 41)), 'deg'),
+        container_item('X-Ray Filters', [
+            code_value_item('X-Ray Filter Type', 'Flat filter'),
+            code_value_item('X-Ray Filter Material', 'Copper or Copper compound'),
+            num_item('X-Ray Filter Thickness Minimum', thickness, 'mm'),
+            num_item('X-Ray Filter Thickness Maximum', thickness, 'mm'),
+            ]),
+        num_item('KVP', kvp, 'kV'),
+        num_item('X-Ray Tube Current', float(rng.integers(5, 50)), 'mA'),
+        num_item('Pulse Rate', 15.0, '{pulse}/s'),
+        num_item('Exposure Time', float(rng.integers(100, 5000)), 'ms'),
+        num_item('Distance Source to Isocenter', sid, 'mm'),
+        num_item('Distance Source to Reference Point', srd, 'mm'),
+        num_item('Distance Source to Detector', sdd, 'mm'),
+        num_item('Collimated Field Area', area, 'm2'),
+        num_item('Table Longitudinal Position', float(rng.integers(-500, 500)), 'mm'),
+        num_item('Table Lateral Position', float(rng.integers(-100, 100)), 'mm'),
+        num_item('Table Height Position', float(rng.integers(-300, 0)), 'mm'),
+        ]
+
+    if event_index % 5 != 4:
+        children.append(num_item('Collimated Field Height', height, 'mm'))
+        children.append(num_item('Collimated Field Width', width, 'mm'))
+
+    return container_item('Irradiation Event X-Ray Data', children)
+
+# Function to write a synthetic RDSR with n_events irradiation events to path
+# The same seed gives the same file content; returns the path
+def write_synthetic_rdsr(path, n_events=50, seed=0, patient_id='SYNTH0001', birth_date='19800101', sex='F', study_date='20240115'):
+
+    rng = np.random.default_rng(seed)
+    uid_seed = f'{patient_id}/{study_date}/{seed}'
+    sop_instance_uid = generate_uid(entropy_srcs=[uid_seed, 'sop'])
+
+    ds = Dataset()
+    ds.SOPClassUID = RDSR_SOP_CLASS_UID
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.StudyInstanceUID = generate_uid(entropy_srcs=[uid_seed, 'study'])
+    ds.SeriesInstanceUID = generate_uid(entropy_srcs=[uid_seed, 'series'])
+    ds.Modality = 'SR'
+    ds.StudyDate = study_date
+    ds.PatientID = patient_id
+    ds.PatientBirthDate = birth_date
+    ds.PatientSex = sex
+    ds.ValueType = 'CONTAINER'
+    ds.ConceptNameCodeSequence = [code_item('X-Ray Radiation Dose Report', '113701')]
+    ds.ContinuityOfContent = 'SEPARATE'
+    ds.ContentSequence = [code_value_item('Procedure reported', 'Fluoroscopy-guided procedure')]
+    ds.ContentSequence.extend(irradiation_event_item(rng, k, study_date, uid_seed) for k in range(n_events))
+
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = RDSR_SOP_CLASS_UID
+    ds.file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    pydicom.dcmwrite(path, ds, enforce_file_format=True)
+
+    return path
+
+# Function to write a corpus of n_files synthetic RDSRs to corpus_dir, one patient per file
+# Returns the paths of the files
+def write_synthetic_corpus(corpus_dir, n_files=10, n_events=50, seed=0):
+
+    os.makedirs(corpus_dir, exist_ok=True)
+
+    return [write_synthetic_rdsr(os.path.join(corpus_dir, f'synthetic_{k:04d}.dcm'), n_events, seed + k,
+                                 patient_id=f'SYNTH{k:04d}', birth_date=f'{1950 + k % 70}0601')
+            for k in range(n_files)]
+
+
+if __name__ == '__main__':
+
+    # Begin Main Processing block (protected by try-except)
+    try:
+
+        #   Please designate the directory of the synthetic corpus, the number of files and of irradiation events per file.
+        corpus_dir = "[Path to synthetic RDSR corpus]"
+        n_files = 20
+        n_events = 200
+
+        dicom_paths = write_synthetic_corpus(corpus_dir, n_files, n_events)
+        print(f'Wrote {len(dicom_paths)} synthetic RDSRs to {corpus_dir}.')
+
+    except Exception as e:
+        print(f"Error: {e}")
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures of the DICOM-to-NCIRF tests
+"""
+
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+V41_PATH = os.path.join(REPO_DIR, 'DICOMtoNCIRF_V4.1_annotated.py')
+
+V2_PATH = os.path.join(REPO_DIR, 'DICOMtoNCIRF_V2.py')
+
+# Fixture loading DICOMtoNCIRF_V4.1_annotated.py, which cannot be imported by name
+# The module is the one the regression harness runs, so that its worker pools can pickle its functions
+@pytest.fixture(scope='session')
+def converter():
+
+    from regression_harness import load_converter
+
+    return load_converter(V41_PATH)
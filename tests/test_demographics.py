@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the phantom age group and sex resolution
+"""
+
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from ncirf_demographics import DemographicsResolver, parse_patient_age, phantom_group_from_age
+
+# Function to make the DICOM JSON header of a study with the given demographics
+def make_raw_dcm(birth_date=None, sex=None, age=None, study_date='20200115', patient_id='P1'):
+
+    raw_dcm = {'00100020': {'vr': 'LO', 'Value': [patient_id]}, '00080020': {'vr': 'DA', 'Value': [study_date]}}
+
+    for tag, vr, value in (('00100030', 'DA', birth_date), ('00100040', 'CS', sex), ('00101010', 'AS', age)):
+        raw_dcm[tag] = {'vr': vr, 'Value': [value]} if value else {'vr': vr}
+
+    return raw_dcm
+
+@pytest.fixture
+def captured_settings(converter, monkeypatch):
+
+    captured = {}
+
+    def process_events(paras, run_settings, *args):
+        captured.update(run_settings)
+        return None, [], []
+
+    monkeypatch.setattr(converter, 'process_events', process_events)
+
+    return captured
+
+def test_birth_date_takes_precedence_over_run_settings(converter, monkeypatch, captured_settings):
+
+    monkeypatch.setattr(converter, 'ret_all_fl_series', lambda path: (make_raw_dcm('20120301', 'M'), []))
+
+    converter.convert_rdsr('study.dcm', {'phantom_group': 6, 'patient_sex': 1})
+
+    assert captured_settings['phantom_group'] == 3
+    assert captured_settings['patient_sex'] == 2
+
+def test_run_settings_fill_in_missing_demographics(converter, monkeypatch, captured_settings):
+
+    monkeypatch.setattr(converter, 'ret_all_fl_series', lambda path: (make_raw_dcm(), []))
+
+    converter.convert_rdsr('study.dcm', {'phantom_group': 6, 'patient_sex': 2})
+
+    assert captured_settings['phantom_group'] == 6
+    assert captured_settings['patient_sex'] == 2
+
+    with pytest.raises(ValueError):
+        converter.convert_rdsr('study.dcm', {})
+
+def test_age_from_another_study_of_the_patient():
+
+    resolver = DemographicsResolver()
+    resolver.add_study({'PatientID': 'P1', 'PatientAge': '004Y', 'StudyDate': '20190101'})
+
+    phantom_group, patient_sex, sources = resolver.resolve({'PatientID': 'P1', 'StudyDate': '20210101'})
+
+    assert phantom_group == phantom_group_from_age(6)
+    assert sources == {'phantom_group': 'PatientAge from another study of the patient', 'patient_sex': 'default'}
+
+def test_birth_date_from_another_study_of_the_patient():
+
+    resolver = DemographicsResolver()
+    resolver.add_study({'PatientID': 'P1', 'PatientBirthDate': '20100301', 'PatientSex': 'M', 'StudyDate': '20190101'})
+
+    phantom_group, patient_sex, sources = resolver.resolve({'PatientID': 'P1', 'PatientAge': '003Y', 'StudyDate': '20200115'})
+
+    assert phantom_group == phantom_group_from_age(9)
+    assert patient_sex == 2
+    assert sources == {'phantom_group': 'birth date from another study of the patient', 'patient_sex': 'another study of the patient'}
+
+def test_least_recently_used_patient_is_evicted():
+
+    resolver = DemographicsResolver(table_size=2)
+    resolver.add_study({'PatientID': 'P1', 'PatientBirthDate': '20100301'})
+    resolver.add_study({'PatientID': 'P2', 'PatientBirthDate': '20120301'})
+    resolver.resolve({'PatientID': 'P1', 'StudyDate': '20200115'})
+    resolver.add_study({'PatientID': 'P3', 'PatientBirthDate': '20140301'})
+
+    assert list(resolver.patient_table) == ['P1', 'P3']
+    assert resolver.resolve({'PatientID': 'P2', 'StudyDate': '20200115'})[0] is None
+
+def test_resolver_is_a_snapshot_in_worker_processes():
+
+    resolver = DemographicsResolver()
+    resolver.add_study({'PatientID': 'P1', 'PatientBirthDate': '20100301', 'PatientSex': 'M'})
+    studies = [{'PatientID': 'P1', 'StudyDate': '20200115'}, {'PatientID': 'P1', 'StudyDate': '20240115'}]
+
+    assert pickle.loads(pickle.dumps(resolver)).resolve(studies[0]) == resolver.resolve(studies[0])
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert list(executor.map(resolver.resolve, studies)) == [resolver.resolve(study) for study in studies]
+        executor.submit(resolver.add_study, {'PatientID': 'P2', 'PatientBirthDate': '20150101'}).result()
+
+    assert list(resolver.patient_table) == ['P1']
+
+def test_parse_patient_age():
+
+    assert parse_patient_age('006M') == 0.5
+    assert parse_patient_age('045Y') == 45
+    assert parse_patient_age('') is None
+    assert parse_patient_age('XYZ') is None
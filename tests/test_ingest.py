@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the ingestion of NCIRF batch results
+"""
+
+import pandas as pd
+import pytest
+
+from ncirf_ingest import aggregate_per_patient, aggregate_per_study, find_batch_outputs, ingest_batch_results
+from ncirf_jobs import build_job_manifest, write_job_manifest
+from ncirf_sinks import InMemoryObjectStoreClient, LocalFileSink, SpoolSink, open_sink, rows_to_csv_bytes
+
+# Function to write an NCIRF batch CSV of n_rows rows and its manifest to a sink
+# patient_id is the DICOM PatientID and ncirf_id the patient ID entered for the batch, the same for every batch as in the harness
+# n_dropped events that failed validation are recorded in the manifest after the emitted ones
+def write_batch(sink, csv_name, patient_id, study_instance_uid, n_rows, n_dropped=0, ncirf_id=100001, job_key=None, created=None):
+
+    derivations = [{'irradiation_event_uid': f'{study_instance_uid}.{n}', 'event_index': n} for n in range(n_rows)]
+    events = [dict(derivation, validation_flags='', dropped=False, emitted=True) for derivation in derivations]
+    events += [{'irradiation_event_uid': f'{study_instance_uid}.{n}', 'event_index': n, 'validation_flags': 'kvp_out_of_range',
+                'dropped': True, 'emitted': False} for n in range(n_rows, n_rows + n_dropped)]
+    manifest = build_job_manifest(job_key or f'key-{study_instance_uid}', csv_name, 'sha', study_instance_uid, patient_id, {'name': 'test'},
+                                  {'patient_id': ncirf_id}, {}, {}, derivations, events)
+    if created:
+        manifest['created'] = created
+
+    with sink:
+        sink.write(csv_name, rows_to_csv_bytes([[ncirf_id]] * n_rows))
+        write_job_manifest(sink, csv_name, manifest)
+
+# Function to write the NCIRF output of a batch
+def write_output(output_dir, batch_name, n_rows, ncirf_id=100001, **extra_columns):
+
+    output = pd.DataFrame({'ID': [ncirf_id] * n_rows, 'Brain': [1.0] * n_rows, 'Lungs': [2.0] * n_rows, **extra_columns})
+    output.to_csv(output_dir / f'{batch_name}_output.csv', index=False)
+
+@pytest.fixture(params=['local', 's3', 'spool'])
+def batch_sink(request, tmp_path):
+
+    if request.param == 'local':
+        (tmp_path / 'batches').mkdir()
+        return LocalFileSink(str(tmp_path / 'batches'), batch_size=2)
+    elif request.param == 's3':
+        return open_sink('s3://registry/batches', batch_size=2, client=InMemoryObjectStoreClient(page_size=1))
+    else:
+        return SpoolSink(str(tmp_path / 'spool'), batch_size=2)
+
+def test_results_are_joined_and_aggregated(batch_sink, tmp_path):
+
+    output_dir = tmp_path / 'output'
+    output_dir.mkdir()
+
+    write_batch(batch_sink, 'a.csv', 'P7', '1.1', 3)
+    write_batch(batch_sink, 'b.csv', 'P7', '1.2', 2, n_dropped=4)
+    write_batch(batch_sink, 'c.csv', 'P8', '1.3', 1)
+
+    for name in batch_sink.list_names():
+        if name.endswith('_manifest.json'):
+            batch_name = name[:-len('_manifest.json')]
+            write_output(output_dir, batch_name, {'a': 3, 'b': 2, 'c': 1}[batch_name[-1]])
+
+    pairs = find_batch_outputs(batch_sink, str(output_dir))
+    results = ingest_batch_results(batch_sink, pairs)
+
+    assert len(pairs) == 3
+    assert list(results.columns[-2:]) == ['Brain', 'Lungs']
+    assert sorted(results['event_key'])[:2] == ['1.1/1.1.0', '1.1/1.1.1']
+
+    per_study = aggregate_per_study(results)
+    assert per_study['event_count'].tolist() == [3, 2, 1]
+    assert per_study['Lungs'].tolist() == [6.0, 4.0, 2.0]
+    assert per_study['dropped_event_count'].tolist() == [0, 4, 0]
+    assert per_study['incomplete'].tolist() == [False, True, False]
+
+    per_patient = aggregate_per_patient(results)
+    assert per_patient['patient_id'].tolist() == ['P7', 'P8']
+    assert per_patient[['study_count', 'event_count']].values.tolist() == [[2, 5], [1, 1]]
+    assert per_patient[['dropped_event_count', 'incomplete_study_count']].values.tolist() == [[4, 1], [0, 0]]
+
+def test_unexpected_columns_are_rejected(tmp_path):
+
+    sink = LocalFileSink(str(tmp_path))
+    write_batch(sink, 'a.csv', 'P7', '1.1', 2)
+    write_output(tmp_path, 'a', 2, Organ=['Liver', 'Liver'])
+    pairs = find_batch_outputs(sink, str(tmp_path))
+
+    with pytest.raises(ValueError, match='Unexpected columns'):
+        ingest_batch_results(sink, pairs)
+
+    results = ingest_batch_results(sink, pairs, ignore_columns=['Organ'])
+    assert 'Organ' not in results
+
+    with pytest.raises(ValueError, match='not numeric'):
+        ingest_batch_results(sink, pairs, organ_columns=['Brain', 'Organ'], ignore_columns=['Lungs'])
+
+    with pytest.raises(ValueError, match='missing'):
+        ingest_batch_results(sink, pairs, organ_columns=['Brain', 'Liver'])
+
+    results = ingest_batch_results(sink, pairs, organ_columns=['Brain'], ignore_columns=['Lungs', 'Organ'])
+    assert results.columns[-1] == 'Brain'
+
+def test_row_count_mismatch_is_rejected(tmp_path):
+
+    sink = LocalFileSink(str(tmp_path))
+    write_batch(sink, 'a.csv', 'P7', '1.1', 2)
+    write_output(tmp_path, 'a', 3)
+
+    with pytest.raises(ValueError, match='rows'):
+        ingest_batch_results(sink, find_batch_outputs(sink, str(tmp_path)))
+
+def test_only_the_newest_batch_of_a_study_is_kept(tmp_path):
+
+    sink = LocalFileSink(str(tmp_path))
+    write_batch(sink, 'a.csv', 'P7', '1.1', 3, job_key='old', created='2026-01-05T10:00:00.000000+05:00')
+    write_batch(sink, 'a_rerun.csv', 'P7', '1.1', 2, job_key='new', created='2026-01-05T06:00:00.000000+00:00')
+    write_output(tmp_path, 'a', 3)
+    write_output(tmp_path, 'a_rerun', 2)
+    pairs = find_batch_outputs(sink, str(tmp_path))
+
+    results = ingest_batch_results(sink, pairs)
+
+    assert len(pairs) == 2
+    assert results['job_key'].unique().tolist() == ['new']
+    assert aggregate_per_study(results)['event_count'].tolist() == [2]
+
+    with pytest.raises(ValueError, match='Event keys'):
+        ingest_batch_results(sink, [pair for pair in pairs if pair[0] == 'a_rerun.csv'] * 2)
+
+    write_batch(sink, 'a_rerun.csv', 'P7', '1.1', 2, job_key='new', created='2026-01-05T05:00:00.000000+00:00')
+
+    with pytest.raises(ValueError, match='same time'):
+        ingest_batch_results(sink, pairs)
+
+def test_newest_batch_without_output_is_not_replaced_by_an_older_one(tmp_path):
+
+    sink = LocalFileSink(str(tmp_path))
+    write_batch(sink, 'a.csv', 'P7', '1.1', 3, job_key='old', created='2026-01-05T10:00:00.000000+00:00')
+    write_batch(sink, 'a_dropped.csv', 'P7', '1.1', 0, n_dropped=3, job_key='dropped', created='2026-01-05T10:00:00.000001+00:00')
+    write_output(tmp_path, 'a', 3)
+    pairs = find_batch_outputs(sink, str(tmp_path))
+
+    assert [pair[0] for pair in pairs] == ['a.csv']
+    assert ingest_batch_results(sink, pairs).empty
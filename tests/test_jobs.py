@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of run profiles, code versions and job keys
+"""
+
+import os
+import sys
+
+import pytest
+
+from conftest import REPO_DIR
+from ncirf_jobs import load_run_profile, build_code_version, compute_job_key, build_job_manifest
+
+def test_load_example_profile():
+
+    profile = load_run_profile(os.path.join(REPO_DIR, 'profiles', 'example.toml'))
+
+    assert profile['name'] == 'example'
+    assert profile['arm_position'] == 1
+
+def test_toml_profile_needs_tomli_without_tomllib(monkeypatch):
+
+    monkeypatch.setitem(sys.modules, 'tomllib', None)
+    monkeypatch.setitem(sys.modules, 'tomli', None)
+
+    with pytest.raises(ImportError, match='tomli'):
+        load_run_profile(os.path.join(REPO_DIR, 'profiles', 'example.toml'))
+
+def test_job_key_follows_every_dependency(tmp_path):
+
+    converter_path = tmp_path / 'converter.py'
+    module_path = tmp_path / 'module.py'
+    converter_path.write_text('x = 1\n')
+    module_path.write_text('threshold = 0.5\n')
+
+    key = compute_job_key('input', {'patient_id': 1}, build_code_version(str(converter_path), '4.1', [str(module_path)]))
+
+    module_path.write_text('threshold = 0.25\n')
+
+    assert compute_job_key('input', {'patient_id': 1}, build_code_version(str(converter_path), '4.1', [str(module_path)])) != key
+
+def test_converter_code_version_covers_its_modules(converter):
+
+    names = set(build_code_version(converter.__file__, converter.CONVERTER_VERSION, converter.code_dependency_paths())['sha256'])
+
+    assert names == {'DICOMtoNCIRF_V4.1_annotated.py', 'ncirf_validation.py', 'ncirf_demographics.py', 'ncirf_jobs.py',
+                     'ncirf_sinks.py', 'hvl_copper_filter.xlsx'}
+
+def test_manifest_lists_every_event():
+
+    derivations = [{'irradiation_event_uid': '1.2.1', 'event_index': 0}]
+    events = [{'event_index': 0, 'irradiation_event_uid': '1.2.1', 'validation_flags': '', 'dropped': False, 'emitted': True},
+              {'event_index': 1, 'irradiation_event_uid': None, 'validation_flags': 'kvp_out_of_range', 'dropped': True, 'emitted': False},
+              {'event_index': 2, 'irradiation_event_uid': '1.2.3', 'validation_flags': '', 'dropped': False, 'emitted': False}]
+
+    manifest = build_job_manifest('key', 'study.dcm', 'sha', '1.2', 'P1', {'name': 'test'}, {'patient_id': 1}, {}, {}, derivations, events)
+
+    assert manifest['event_counts'] == {'events': 3, 'emitted': 1, 'dropped': 1, 'not_simulated': 1}
+    assert manifest['created'].endswith('+00:00')
+    assert not manifest['complete']
+    assert [event['event_key'] for event in manifest['events']] == ['1.2/1.2.1', '1.2/event-1', '1.2/1.2.3']
+    assert manifest['rows'][0]['event_key'] == manifest['events'][0]['event_key']
+
+    manifest = build_job_manifest('key', 'study.dcm', 'sha', '1.2', 'P1', {'name': 'test'}, {'patient_id': 1}, {}, {}, derivations, events[:1])
+
+    assert manifest['complete']
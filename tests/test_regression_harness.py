@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the regression harness on a synthetic RDSR corpus
+"""
+
+import subprocess
+import sys
+
+import pytest
+
+from conftest import REPO_DIR, V2_PATH, V41_PATH
+import regression_harness
+from regression_harness import benchmark_event_workers, compare_converters, diff_rows, run_converter
+from synthetic_rdsr import write_synthetic_corpus, write_synthetic_rdsr
+
+RUN_SETTINGS = {'patient_id': 100001, 'arm_position': 1, 'iso_x': 44.0, 'iso_y': 13.5, 'iso_z': 121.0,
+                'history_num': 1000000, 'cpu_core_num': 8}
+
+@pytest.fixture(scope='module')
+def corpus(tmp_path_factory):
+    return write_synthetic_corpus(str(tmp_path_factory.mktemp('corpus')), n_files=3, n_events=24)
+
+def test_synthetic_rdsr_is_reproducible(tmp_path):
+
+    first = open(write_synthetic_rdsr(str(tmp_path / 'a.dcm'), 10, seed=3), 'rb').read()
+    second = open(write_synthetic_rdsr(str(tmp_path / 'b.dcm'), 10, seed=3), 'rb').read()
+
+    assert first == second
+
+def test_synthetic_events_pass_validation(converter, corpus):
+
+    raw_dcm, paras = converter.ret_all_fl_series(corpus[0])
+    validation = converter.process_events(paras, dict(RUN_SETTINGS, phantom_group=6, patient_sex=1))[0]
+
+    assert len(paras) == 24
+    assert not validation['invalid'].any()
+
+def test_v41_against_itself_with_parallel_events(corpus):
+
+    mismatches, throughput = compare_converters(V41_PATH, V41_PATH, corpus, RUN_SETTINGS,
+                                                candidate_options={'n_workers': 2, 'chunk_size': 5})
+
+    assert mismatches.empty
+    assert throughput['failed_files'].tolist() == [0, 0]
+    assert throughput['rows'].tolist() == [72, 72]
+    assert (throughput['cpu_time_s'] > 0).all()
+
+def test_v2_against_v41_reports_differences(corpus):
+
+    mismatches, throughput = compare_converters(V2_PATH, V41_PATH, corpus, RUN_SETTINGS, n_workers=2,
+                                                ignore_columns=['ID', 'History', 'Threads'])
+
+    assert throughput['failed_files'].tolist() == [0, 0]
+    assert set(mismatches['column']) >= {'HVL', 'Field Width'}
+
+def test_benchmark_event_workers(corpus):
+
+    benchmark = benchmark_event_workers(V41_PATH, corpus, RUN_SETTINGS, worker_counts=(1, 2), chunk_size=5)
+
+    assert benchmark['n_workers'].tolist() == [1, 2]
+    assert benchmark['failed_files'].tolist() == [0, 0]
+    assert benchmark['rows'].tolist() == [72, 72]
+    assert benchmark['speedup'].iat[0] == 1
+
+def test_parallel_events_under_spawn(corpus):
+
+    # The start method is set once per interpreter, so the comparison runs in a fresh one
+    script = '\n'.join([
+        'import multiprocessing, sys',
+        f'sys.path.insert(0, {REPO_DIR!r})',
+        'from regression_harness import compare_converters',
+        "if __name__ == '__main__':",
+        "    multiprocessing.set_start_method('spawn')",
+        f'    mismatches, throughput = compare_converters({V41_PATH!r}, {V41_PATH!r}, {corpus[:1]!r}, {RUN_SETTINGS!r},',
+        "                                                candidate_options={'n_workers': 2, 'chunk_size': 5})",
+        "    print(len(mismatches), throughput['failed_files'].tolist(), throughput['rows'].tolist())",
+        ])
+
+    completed = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, timeout=300)
+
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.split('\n')[-2] == '0 [0, 0] [24, 24]'
+
+def test_diff_rows_tolerances():
+
+    reference = [[1, 1, 6, 1, 80, 3.01, 75.0]]
+    candidate = [[1, 1, 6, 1, 80, 3.01, 75.001]]
+
+    assert diff_rows(reference, candidate).iloc[0]['column'] == 'SID'
+    assert diff_rows(reference, candidate, tolerances={'SID': {'atol': 1e-2}}).empty
+    assert diff_rows(reference, reference + reference).iloc[0]['column'] == 'rows'
+
+def test_diff_rows_missing_values():
+
+    reference = [[1, 1, 6, 1, 80, 3.01, None], [1, 1, 6, 1, 80, None, 75.0]]
+
+    assert diff_rows(reference, [list(row) for row in reference]).empty
+    assert diff_rows(reference, [reference[0], [1, 1, 6, 1, 80, 3.01, 75.0]])[['row', 'column']].values.tolist() == [[1, 'HVL']]
+
+def test_diff_rows_of_different_lengths():
+
+    reference = [[1, 1, 6, 1, 80, 75.0], [1, 1, 6, 1, 80, 3.01, 75.0], [1, 1, 6, 1, 80, 3.01, 75.0]]
+    candidate = [[1, 1, 6, 1, 80, 3.01, 75.0], [1, 1, 6, 1, 80, 3.01], [1, 1, 6, 1, 80, 3.01, 76.0]]
+
+    mismatches = diff_rows(reference, candidate)
+
+    assert mismatches[['row', 'column']].values.tolist() == [[0, 'row_length'], [1, 'row_length'], [2, 'SID']]
+    assert mismatches[['reference', 'candidate']].values.tolist()[:2] == [[6, 7], [7, 6]]
+
+def test_diff_errors_are_reported_per_file(corpus, monkeypatch):
+
+    def diff_rows(reference_rows, candidate_rows, *args):
+        raise ValueError('cannot diff')
+
+    monkeypatch.setattr(regression_harness, 'diff_rows', diff_rows)
+
+    mismatches, throughput = compare_converters(V41_PATH, V41_PATH, corpus, RUN_SETTINGS)
+
+    assert mismatches['column'].tolist() == ['diff_error'] * len(corpus)
+    assert mismatches['candidate'].iat[0] == 'ValueError: cannot diff'
+
+def test_run_converter_reports_errors(tmp_path):
+
+    rows, seconds, cpu_seconds, error = run_converter(V41_PATH, str(tmp_path / 'missing.dcm'), RUN_SETTINGS)
+
+    assert rows == []
+    assert error.startswith('FileNotFoundError')
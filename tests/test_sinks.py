@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the output sinks
+"""
+
+import os
+
+import pytest
+
+from ncirf_jobs import is_job_current, write_job_manifest
+from ncirf_sinks import (AtomicFileSink, InMemoryObjectStoreClient, LocalFileSink, ObjectStoreClientError,
+                         ObjectStoreSink, OutputSink, SpoolSink, is_missing_object_error, open_sink, rows_to_csv_bytes)
+
+def test_atomic_sink_leaves_no_temporary_files(tmp_path):
+
+    with AtomicFileSink(str(tmp_path), batch_size=2) as sink:
+        sink.write('study.csv', rows_to_csv_bytes([[1, 2], [3, 4]]))
+        sink.write('study_manifest.json', '{}')
+
+    assert sorted(os.listdir(tmp_path)) == ['study.csv', 'study_manifest.json']
+    assert sink.read('study.csv') == rows_to_csv_bytes([[1, 2], [3, 4]])
+
+def test_atomic_sink_keeps_the_old_file_when_a_write_fails(tmp_path, monkeypatch):
+
+    sink = AtomicFileSink(str(tmp_path))
+    sink.write('study.csv', b'old')
+
+    def failing_replace(source, destination):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(os, 'replace', failing_replace)
+
+    with pytest.raises(OSError):
+        sink.write('study.csv', b'new')
+
+    assert os.listdir(tmp_path) == ['study.csv']
+    assert sink.read('study.csv') == b'old'
+
+def test_pending_outputs_are_discarded_when_the_block_raises(tmp_path):
+
+    with pytest.raises(RuntimeError):
+        with LocalFileSink(str(tmp_path), batch_size=2) as sink:
+            sink.write('study.csv', b'1,2')
+            raise RuntimeError('conversion failed')
+
+    assert os.listdir(tmp_path) == []
+
+def test_sink_without_write_one_cannot_be_created():
+
+    class IncompleteSink(OutputSink):
+        pass
+
+    with pytest.raises(TypeError, match='write_one'):
+        IncompleteSink()
+
+def test_spool_sink_pairs_csv_and_manifest(tmp_path, monkeypatch):
+
+    published = []
+    replace = os.replace
+
+    def recording_replace(source, destination):
+        published.append(os.path.basename(destination))
+        replace(source, destination)
+
+    monkeypatch.setattr(os, 'replace', recording_replace)
+
+    with SpoolSink(str(tmp_path), batch_size=2, job_id='abc123') as sink:
+        sink.write('study.csv', b'1,2')
+        write_job_manifest(sink, 'study.csv', {'job_key': 'abc123'})
+
+    assert published == ['abc123_study_manifest.json', 'abc123_study.csv']
+    assert os.listdir(tmp_path / 'tmp') == []
+    assert not is_job_current(sink, 'study.csv', 'abc123')
+
+def test_spool_sink_uses_one_id_per_batch(tmp_path):
+
+    with SpoolSink(str(tmp_path), batch_size=2) as sink:
+        sink.write('study.csv', b'1,2')
+        sink.write('study_manifest.json', b'{}')
+
+    prefixes = {name[:-len('_study.csv')] if name.endswith('.csv') else name[:-len('_study_manifest.json')]
+                for name in os.listdir(tmp_path / 'new')}
+
+    assert len(os.listdir(tmp_path / 'new')) == 2
+    assert len(prefixes) == 1
+
+def test_object_store_sink_round_trip():
+
+    client = InMemoryObjectStoreClient()
+    sink = open_sink('s3://registry/ncirf/batches', batch_size=2, client=client)
+
+    assert isinstance(sink, ObjectStoreSink)
+    assert not sink.exists('study.csv')
+    assert sink.read('study.csv') is None
+
+    with sink:
+        sink.write('study.csv', b'1,2')
+        write_job_manifest(sink, 'study.csv', {'job_key': 'abc123'})
+
+    assert set(client.objects) == {('registry', 'ncirf/batches/study.csv'), ('registry', 'ncirf/batches/study_manifest.json')}
+    assert sink.read('study.csv') == b'1,2'
+    assert is_job_current(sink, 'study.csv', 'abc123')
+    assert not is_job_current(sink, 'study.csv', 'def456')
+
+def test_is_missing_object_error():
+
+    assert is_missing_object_error(ObjectStoreClientError('NoSuchKey', 'GetObject'))
+    assert is_missing_object_error(ObjectStoreClientError('404', 'HeadObject'))
+    assert is_missing_object_error(KeyError('study.csv'))
+    assert not is_missing_object_error(ObjectStoreClientError('AccessDenied', 'GetObject'))
+    assert not is_missing_object_error(ValueError('bad data'))
+
+def test_other_object_store_errors_are_raised():
+
+    client = InMemoryObjectStoreClient()
+
+    def denied(**kwargs):
+        raise ObjectStoreClientError('AccessDenied', 'GetObject')
+
+    client.get_object = denied
+
+    with pytest.raises(ObjectStoreClientError):
+        ObjectStoreSink('registry', client=client).read('study.csv')
+
+@pytest.mark.parametrize('target, sink_type, location', [
+    ('atomic:///data/ncirf', AtomicFileSink, '/data/ncirf'),
+    ('atomic://data/ncirf', AtomicFileSink, 'data/ncirf'),
+    ('/data/ncirf', LocalFileSink, '/data/ncirf'),
+    ('data/ncirf', LocalFileSink, 'data/ncirf'),
+    ])
+def test_open_sink_parses_local_targets(target, sink_type, location):
+
+    sink = open_sink(target)
+
+    assert type(sink) is sink_type
+    assert sink.directory == location
+
+def test_open_sink_parses_spool_targets(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+
+    assert open_sink('spool://spool/ncirf').new_dir == os.path.join('spool/ncirf', 'new')
+    assert open_sink(f'spool://{tmp_path}/abs').new_dir == os.path.join(f'{tmp_path}/abs', 'new')
+    assert os.path.isdir(tmp_path / 'spool' / 'ncirf' / 'tmp')
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the irradiation event validation and of the unit conversions of build_ncirf_row
+"""
+
+from math import sqrt
+
+import pytest
+
+from ncirf_validation import validate_events, summarize_validation, field_size_method, BLOCKING_FLAGS
+
+RUN_SETTINGS = {'patient_id': 1, 'arm_position': 1, 'phantom_group': 6, 'patient_sex': 1,
+                'iso_x': 44.0, 'iso_y': 13.5, 'iso_z': 121.0, 'history_num': 1000000, 'cpu_core_num': 4}
+
+# Function to make the parameter dictionary of a plausible irradiation event
+# changes maps parameter names to new values; None removes the parameter
+def make_event(changes=None):
+
+    event = {
+        'Irradiation Event UID': '1.2.3.4',
+        'KVP': 78.0,
+        'X-Ray Filter Material': 'Copper or Copper compound',
+        'X-Ray Filter Thickness Minimum': 0.2,
+        'X-Ray Filter Thickness Maximum': 0.2,
+        'Distance Source to Isocenter': 750.0,
+        'Distance Source to Reference Point': 600.0,
+        'Distance Source to Detector': 1000.0,
+        'Collimated Field Width': 150.0,
+        'Collimated Field Height': 120.0,
+        'Collimated Field Area': 0.018,
+        'Dose Area Product': 0.0001,
+        'Dose (RP)': 0.0001 / (0.018 * 0.36),
+        'Positioner Primary Angle': 10.0,
+        'Positioner Secondary Angle': -5.0,
+        }
+
+    for name, value in (changes or {}).items():
+        if value is None:
+            event.pop(name)
+        else:
+            event[name] = value
+
+    return event
+
+def test_plausible_event_is_not_flagged():
+
+    flags = validate_events([make_event()])
+
+    assert flags['validation_flags'].iat[0] == ''
+    assert not flags['invalid'].iat[0]
+
+@pytest.mark.parametrize('changes, flag', [
+    ({'KVP': 140.0}, 'kvp_out_of_range'),
+    ({'KVP': 47.0}, 'kvp_out_of_range'),
+    ({'KVP': None}, 'missing_parameters'),
+    ({'X-Ray Filter Material': 'Aluminum or Aluminum compound'}, 'filter_not_supported'),
+    ({'X-Ray Filter Thickness Minimum': 1.2, 'X-Ray Filter Thickness Maximum': 1.2}, 'filter_not_supported'),
+    ({'X-Ray Filter Thickness Maximum': 0.3}, 'filter_not_flat'),
+    ({'Distance Source to Reference Point': 0.0}, 'zero_distance'),
+    ({'Distance Source to Reference Point': None, 'Distance Source to Isocenter': 150.0}, 'zero_distance'),
+    ({'Distance Source to Detector': 0.0}, 'zero_distance'),
+    ({'Distance Source to Detector': 500.0}, 'implausible_geometry'),
+    ({'Collimated Field Width': 300.0}, 'field_size_dap_mismatch'),
+    ({'Positioner Primary Angle': None}, 'missing_parameters'),
+    ])
+def test_flags(changes, flag):
+
+    flags = validate_events([make_event(changes)])
+
+    assert flags[flag].iat[0]
+    assert flags['invalid'].iat[0]
+    assert flags['unconvertible'].iat[0] == (flag in BLOCKING_FLAGS)
+
+def test_events_without_dap_are_not_flagged():
+
+    flags = validate_events([make_event({'Dose Area Product': 0, 'KVP': 200.0})])
+
+    assert not flags['invalid'].iat[0]
+
+@pytest.mark.parametrize('changes, method', [
+    ({}, 'width_height'),
+    ({'Collimated Field Width': None, 'Collimated Field Height': None}, 'area'),
+    ({'Collimated Field Width': 0.0}, 'dap_dose_rp'),
+    ({'Collimated Field Area': 0.0}, 'dap_dose_rp'),
+    # Width and height present but zero, area positive and Dose (RP) zero: sqrt(DAP / Dose (RP)) cannot be taken
+    ({'Collimated Field Width': 0.0, 'Collimated Field Height': 0.0, 'Dose (RP)': 0.0}, None),
+    # Width and height present, area missing: the builder reads the area first
+    ({'Collimated Field Area': None}, None),
+    ({'Collimated Field Width': None, 'Collimated Field Area': -0.01}, None),
+    ({'Collimated Field Area': 0.0, 'Dose (RP)': None}, None),
+    ])
+def test_field_size_method(changes, method):
+
+    event = make_event(changes)
+    flags = validate_events([event])
+
+    assert field_size_method(event) == method
+    assert flags['no_field_size'].iat[0] == (method is None)
+
+def test_unflagged_events_are_converted(converter):
+
+    variants = [{}, {'Collimated Field Width': None, 'Collimated Field Height': None}, {'Collimated Field Area': 0.0},
+                {'Distance Source to Reference Point': None}, {'KVP': 124.0}, {'KVP': 50.0},
+                {'Collimated Field Area': None}, {'Dose (RP)': 0.0, 'Collimated Field Width': 0.0},
+                {'KVP': 130.0}, {'X-Ray Filter Material': 'Aluminum'}, {'Distance Source to Detector': 0.0},
+                {'X-Ray Filter Thickness Maximum': 0.3}, {'Positioner Secondary Angle': None}]
+    events = [make_event(changes) for changes in variants]
+
+    flags = validate_events(events)
+
+    for event, unconvertible in zip(events, flags['unconvertible']):
+        if unconvertible:
+            with pytest.raises(Exception):
+                converter.build_ncirf_row(event, RUN_SETTINGS)
+        else:
+            ncirf, derivation = converter.build_ncirf_row(event, RUN_SETTINGS)
+            assert len(ncirf) == 17
+
+def test_unit_conversions(converter):
+
+    event = make_event()
+    ncirf, derivation = converter.build_ncirf_row(event, RUN_SETTINGS)
+
+    cf_sdd = 750.0 / 1000.0
+
+    assert ncirf[4] == 80 # KVP rounded to 10 kV
+    assert ncirf[6] == pytest.approx(75.0) # SID mm -> cm
+    assert ncirf[7] == pytest.approx(15.0 * cf_sdd) # width mm -> cm, detector -> isocenter
+    assert ncirf[8] == pytest.approx(12.0 * cf_sdd)
+    assert ncirf[9] == pytest.approx(1.0) # DAP Gy*m^2 -> Gy*cm^2
+    assert ncirf[10:15] == [10.0, -5.0, 44.0, 13.5, 121.0]
+
+    ncirf, derivation = converter.build_ncirf_row(make_event({'Collimated Field Width': None, 'Collimated Field Height': None}), RUN_SETTINGS)
+    assert ncirf[7] == pytest.approx(sqrt(0.018) * 100 * cf_sdd) # area m^2 -> side in cm
+
+    event = make_event({'Collimated Field Area': 0.0})
+    ncirf, derivation = converter.build_ncirf_row(event, RUN_SETTINGS)
+    assert ncirf[7] == pytest.approx(sqrt(event['Dose Area Product'] / event['Dose (RP)']) * 100 * 750.0 / 600.0)
+
+    ncirf, derivation = converter.build_ncirf_row(make_event({'Collimated Field Area': 0.0, 'Distance Source to Reference Point': None}), RUN_SETTINGS)
+    assert derivation['srd'] == 'Distance Source to Isocenter - 150'
+
+def test_keep_mode_leaves_out_unconvertible_events(converter, monkeypatch):
+
+    events = [make_event(), make_event({'KVP': 200.0}), make_event({'Distance Source to Detector': 500.0}),
+              make_event({'Collimated Field Width': 0.0, 'Dose (RP)': 0.0})]
+
+    monkeypatch.setattr(converter, 'extract_event_parameters', lambda event: event)
+
+    validation, ncirf_all, derivation_all = converter.process_events(events, RUN_SETTINGS)
+
+    assert summarize_validation(validation)['unconvertible'] == 2
+    assert [d['event_index'] for d in derivation_all] == [0, 2]
+    assert 'implausible_geometry' in derivation_all[1]['validation_flags']
+    assert validation['dropped'].tolist() == [False, True, False, True]
+    assert validation['emitted'].tolist() == [True, False, True, False]
+
+    validation, ncirf_all, derivation_all = converter.process_events(events, RUN_SETTINGS, drop_invalid=True)
+
+    assert [d['event_index'] for d in derivation_all] == [0]
+    assert validation['dropped'].tolist() == [False, True, True, True]
+
+def test_events_without_dap_are_neither_dropped_nor_emitted(converter, monkeypatch):
+
+    events = [make_event({'Dose Area Product': 0.0}), make_event()]
+
+    monkeypatch.setattr(converter, 'extract_event_parameters', lambda event: event)
+
+    validation, ncirf_all, derivation_all = converter.process_events(events, RUN_SETTINGS, chunk_size=1)
+
+    assert validation.index.tolist() == [0, 1]
+    assert validation[['dropped', 'emitted']].values.tolist() == [[False, False], [False, True]]
+    assert validation['irradiation_event_uid'].tolist() == ['1.2.3.4', '1.2.3.4']